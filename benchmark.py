@@ -0,0 +1,772 @@
+"""Local load benchmarks for the SMS platform.
+
+Mongo subcommands run against a local mongod (MONGO_URI, default
+mongodb://localhost:27017/) using a throwaway database; gateway traffic
+goes to fake gateway servers started on localhost:
+
+    python benchmark.py mongo --clients 1 10 50 100 --requests 5000
+    python benchmark.py analytics --days 90 --receipts 1000000
+    python benchmark.py bulk --records 10000 --batch-size 500
+    python benchmark.py cache --requests 5000
+    python benchmark.py ussd --sessions 100 1000 10000 --hops 5
+    python benchmark.py otp --users 10000 --concurrency 50
+    python benchmark.py startup --runs 10
+    python benchmark.py serialization --docs 1000 --rounds 20
+    python benchmark.py templates --messages 1000000 --batch-size 1000
+    python benchmark.py suppression --suppressed 1000000 --recipients 2000000
+    python benchmark.py dispatch --gateways 4 --workers 1 2 4 --messages 200000
+    python benchmark.py balancer --messages 100000
+    python benchmark.py ledger --workers 4 --tasks 50 --batches 200
+    python benchmark.py fake-gateway --port 9000 --latency 0.005
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+
+import httpx
+from bson import ObjectId
+from pymongo import AsyncMongoClient, MongoClient, UpdateOne
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+BENCH_DB = "sms_platform_bench"
+
+def report(label: str, ops: int, elapsed: float):
+    print(f"{label:<45} {ops:>9} ops {elapsed:9.3f}s {ops / elapsed:12.1f} ops/s")
+
+def report_latency(label: str, samples: list):
+    samples = sorted(samples)
+    p50 = samples[len(samples) // 2] * 1000
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000
+    mean = sum(samples) / len(samples) * 1000
+    print(f"{label:<45} {len(samples):>9} ops mean {mean:7.3f}ms p50 {p50:7.3f}ms p99 {p99:7.3f}ms")
+
+# Mongo driver: blocking pymongo vs AsyncMongoClient under N concurrent clients
+async def bench_mongo(clients: list, requests: int):
+    sync_client = MongoClient(MONGO_URI)
+    async_client = AsyncMongoClient(MONGO_URI, maxPoolSize=max(clients))
+    sync_coll = sync_client[BENCH_DB]["campaign"]
+    async_coll = async_client[BENCH_DB]["campaign"]
+    sync_coll.drop()
+    sync_coll.create_index([("id", 1)], unique=True)
+    sync_coll.insert_one({"id": "bench", "nm": "bench", "status": "active"})
+
+    async def blocking_client(n: int):
+        # What the handlers did before: a sync call inside a coroutine
+        for _ in range(n):
+            sync_coll.find_one({"id": "bench"})
+
+    async def async_client_loop(n: int):
+        for _ in range(n):
+            await async_coll.find_one({"id": "bench"})
+
+    for n in clients:
+        per_client = max(1, requests // n)
+        for label, worker in (("blocking", blocking_client), ("async", async_client_loop)):
+            started = time.perf_counter()
+            await asyncio.gather(*(worker(per_client) for _ in range(n)))
+            report(f"find_one {label} clients={n}", per_client * n, time.perf_counter() - started)
+
+    sync_coll.drop()
+    sync_client.close()
+    await async_client.close()
+
+# Analytics: range query over pre-aggregated buckets vs aggregating raw receipts
+async def bench_analytics(days: int, receipts: int, queries: int):
+    import main
+
+    client = AsyncMongoClient(MONGO_URI)
+    raw, rollup = client[BENCH_DB]["dlr"], client[BENCH_DB]["analytic_rollup"]
+    await raw.drop()
+    await rollup.drop()
+    await raw.create_index([("campaign_id", 1), ("timestamp_dt", 1)])
+    await rollup.create_index([("campaign_id", 1), ("granularity", 1), ("timestamp_dt", 1)], unique=True)
+
+    end = datetime.utcnow().replace(microsecond=0)
+    start = end - timedelta(days=days)
+    span = int((end - start).total_seconds())
+    counts = Counter()
+    for offset in range(0, receipts, 10000):
+        docs = []
+        for _ in range(min(10000, receipts - offset)):
+            ts = start + timedelta(seconds=random.randrange(span))
+            status = "delivered" if random.random() < 0.9 else "failed"
+            docs.append({"campaign_id": "bench", "status": status, "timestamp_dt": ts})
+            for granularity in main.ROLLUP_GRANULARITIES:
+                counts[(granularity, main.bucket_start(ts, granularity), status)] += 1
+        await raw.insert_many(docs, ordered=False)
+    await rollup.bulk_write(
+        [
+            UpdateOne(
+                {"campaign_id": "bench", "granularity": granularity, "timestamp_dt": bucket},
+                {"$inc": {"metrics.total": n, f"metrics.{status}": n}},
+                upsert=True,
+            )
+            for (granularity, bucket, status), n in counts.items()
+        ],
+        ordered=False,
+    )
+
+    window = {"campaign_id": "bench", "timestamp_dt": {"$gte": start, "$lte": end}}
+    for granularity in ("day", "hour"):
+        started = time.perf_counter()
+        for _ in range(queries):
+            await raw.aggregate(
+                [
+                    {"$match": window},
+                    {"$group": {
+                        "_id": {"$dateTrunc": {"date": "$timestamp_dt", "unit": granularity}},
+                        "total": {"$sum": 1},
+                        "delivered": {"$sum": {"$cond": [{"$eq": ["$status", "delivered"]}, 1, 0]}},
+                    }},
+                    {"$sort": {"_id": 1}},
+                ]
+            ).to_list(None)
+        report(f"{days}d by {granularity}: aggregate raw", queries, time.perf_counter() - started)
+        started = time.perf_counter()
+        for _ in range(queries):
+            await rollup.find({**window, "granularity": granularity}).sort("timestamp_dt", 1).to_list(None)
+        report(f"{days}d by {granularity}: read buckets", queries, time.perf_counter() - started)
+
+    await raw.drop()
+    await rollup.drop()
+    await client.close()
+
+# Bulk writes: per-item endpoints vs one bulk_write per batch, through the ASGI app
+async def bench_bulk(records: int, batch_size: int, concurrency: int):
+    import main
+
+    main.Collections.user = main.client[BENCH_DB]["user"]
+    await main.Collections.user.drop()
+    await main.Collections.user.create_index([("id", 1)], unique=True)
+    await main.Collections.user.create_index([("email", 1)], unique=True)
+
+    def user(run: str, i: int) -> dict:
+        return {
+            "id": f"{run}-{i}",
+            "nm": "bench",
+            "email": f"{run}-{i}@bench.test",
+            "phone_nb": "+254700000001",
+            "role": "user",
+        }
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as api:
+        async def post_items(run: str, indexes: range):
+            for i in indexes:
+                await api.post("/users/", json=user(run, i))
+
+        started = time.perf_counter()
+        per_client = records // concurrency
+        await asyncio.gather(
+            *(post_items("single", range(c * per_client, (c + 1) * per_client)) for c in range(concurrency))
+        )
+        report(f"POST /users/ x{concurrency} clients", per_client * concurrency, time.perf_counter() - started)
+
+        for label, method in (("POST", "post"), ("PUT", "put")):
+            started = time.perf_counter()
+            for offset in range(0, records, batch_size):
+                batch = [user("bulk", i) for i in range(offset, min(records, offset + batch_size))]
+                await getattr(api, method)("/users/bulk", json=batch)
+            report(f"{label} /users/bulk batch={batch_size}", records, time.perf_counter() - started)
+
+    await main.Collections.user.drop()
+
+async def bench_cache(requests: int):
+    import main
+
+    main.Collections.gateway = main.client[BENCH_DB]["gateway"]
+    await main.Collections.gateway.drop()
+    await main.Collections.gateway.create_index([("id", 1)], unique=True)
+    await main.Collections.gateway.insert_one(
+        {"id": "bench", "nm": "bench", "api_endpoint": "http://127.0.0.1/send", "api_key": "bench-key-0001", "status": "active"}
+    )
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as api:
+        for label, ttl in (("uncached", 0), ("cached", main.CACHE_TTL or 60)):
+            main.Caches.gateway.ttl = ttl
+            main.Caches.gateway.clear()
+            samples = []
+            for _ in range(requests):
+                started = time.perf_counter()
+                await api.get("/sms-gateways/bench")
+                samples.append(time.perf_counter() - started)
+            report_latency(f"GET /sms-gateways/{{id}} {label}", samples)
+    print("gateway cache", main.Caches.gateway.stats())
+
+    await main.Collections.gateway.drop()
+
+async def bench_ussd(sessions: list, hops: int):
+    import main
+
+    main.Collections.ussd_service = main.client[BENCH_DB]["ussd_service"]
+    await main.Collections.ussd_service.drop()
+    await main.Collections.ussd_service.insert_one(
+        {
+            "cd": "*384#",
+            "ds": "Bench menu",
+            "menu_options": [f"Menu {a}>Item {b}>Leaf {c}" for a in range(1, 6) for b in range(1, 6) for c in range(1, 4)],
+            "session_timeout": 120,
+        }
+    )
+
+    async def session(session_id: str, samples: list, call):
+        # Walk down two levels and back up so every hop keeps the session open
+        text = ""
+        for hop in range(hops):
+            choice = "0" if hop % 3 == 2 else str(random.randint(1, 5))
+            text = f"{text}*{choice}" if hop else ""
+            started = time.perf_counter()
+            await call(main.USSDRequest(session_id=session_id, service_cd="*384#", phone_nb="+254700000001", text=text))
+            samples.append(time.perf_counter() - started)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as api:
+        async def http_call(request):
+            await api.post("/ussd/callback", json=request.model_dump())
+
+        for label, call in (("engine", main.ussd_hop), ("POST /ussd/callback", http_call)):
+            for count in sessions:
+                samples = []
+                await asyncio.gather(*(session(f"{label}-{count}-{n}", samples, call) for n in range(count)))
+                report_latency(f"{label} {count} concurrent sessions", samples)
+    print("ussd sessions", main.ussd_sessions.stats())
+
+    await main.Collections.ussd_service.drop()
+
+async def bench_otp(users: int, concurrency: int):
+    import main
+
+    main.Collections.otp = main.client[BENCH_DB]["otp"]
+    main.Collections.user = main.client[BENCH_DB]["user"]
+    await main.Collections.otp.drop()
+    await main.Collections.user.drop()
+    await main.Collections.user.insert_many([{"id": f"bench-{i}", "phone_nb": f"+2547{i:08d}"} for i in range(users)])
+    await main.Collections.otp.create_index([("user_id", 1), ("created_dt", -1), ("_id", -1)])
+    await main.Collections.otp.create_index([("expiry_dt", 1)], expireAfterSeconds=0)
+    main.otp_issues.limit = main.otp_attempts.limit = users
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as api:
+        async def run(label: str, make_request):
+            async def client_loop(c: int):
+                for i in range(c, users, concurrency):
+                    await make_request(i)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(client_loop(c) for c in range(concurrency)))
+            report(f"{label} x{concurrency} clients", users, time.perf_counter() - started)
+
+        codes = {}
+
+        # Codes only leave the API by SMS; capture them instead of timing a gateway, which dispatch covers
+        async def send_otp_sms(phone_nb: str, cd: str) -> bool:
+            codes[int(phone_nb[5:])] = cd
+            return True
+
+        main.send_otp_sms = send_otp_sms
+
+        async def issue(i: int):
+            response = await api.post("/otp/issue", json={"user_id": f"bench-{i}", "phone_nb": f"+2547{i:08d}"})
+            assert response.status_code == 200, response.text
+
+        async def verify_wrong(i: int):
+            wrong = "000000" if codes[i] != "000000" else "111111"
+            await api.post("/otp/verify", json={"user_id": f"bench-{i}", "cd": wrong})
+
+        async def verify(i: int):
+            response = await api.post("/otp/verify", json={"user_id": f"bench-{i}", "cd": codes[i]})
+            assert response.status_code == 200, response.text
+
+        await run("POST /otp/issue", issue)
+        await run("POST /otp/verify wrong code", verify_wrong)
+        await run("POST /otp/verify", verify)
+
+    await main.Collections.otp.drop()
+    await main.Collections.user.drop()
+
+STARTUP_PROBE = """
+import asyncio, json, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+async def probe():
+    async with main.lifespan(main.app):
+        return time.perf_counter()
+ready = asyncio.run(probe())
+print(json.dumps([imported - started, ready - imported]))
+"""
+
+def bench_startup(runs: int):
+    # Each run is a fresh interpreter, so nothing is warm except the OS file cache
+    here = os.path.dirname(os.path.abspath(__file__))
+    process, imports, lifespans = [], [], []
+    # The probe still runs the unique index check, but a bare database only logs it
+    env = {**os.environ, "OTP_SECRET": os.getenv("OTP_SECRET", "benchmark"), "ALLOW_MISSING_UNIQUE_INDEXES": "1"}
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE], cwd=here, env=env, capture_output=True, text=True, check=True
+        ).stdout
+        process.append(time.perf_counter() - started)
+        import_s, lifespan_s = json.loads(output.splitlines()[-1])
+        imports.append(import_s)
+        lifespans.append(lifespan_s)
+    report_latency("cold start: process to ready", process)
+    report_latency("cold start: import main", imports)
+    report_latency("cold start: lifespan startup", lifespans)
+
+def sample_documents(now: datetime) -> dict:
+    # One document per original model, shaped as it comes back from Mongo
+    return {
+        "Campaign": {"id": "c-1", "nm": "Launch", "ds": "Spring launch", "start_dt": now, "end_dt": now,
+                     "target_audience": ["+254700000001", "+254700000002"], "status": "active"},
+        "USSDService": {"cd": "*384#", "ds": "Main menu", "menu_options": ["Account>Balance", "Help"], "session_timeout": 120},
+        "Shortcode": {"cd": "22384", "type": "dedicated", "ds": "Marketing"},
+        "Analytics": {"campaign_id": "c-1", "delivery_rt": 97.5, "metrics": {"total": 1000, "delivered": 975},
+                      "timestamp_dt": now},
+        "OTPAuthentication": {"user_id": "u-1", "cd": None, "phone_nb": "+254700000001", "expiry_dt": now},
+        "SMSGateway": {"id": "g-1", "nm": "Primary", "api_endpoint": "https://gw.example/send",
+                       "api_key": "secret-key-0001", "status": "active", "weight": 1.0, "tps": 100.0},
+        "User": {"id": "u-1", "nm": "Jane", "email": "jane@example.com", "phone_nb": "+254700000001", "role": "user"},
+        "Scheduler": {"id": "s-1", "nm": "Nightly", "ds": "Nightly send", "campaign_id": "c-1", "schedule_dt": now,
+                      "status": "pending"},
+        "Service": {"id": "sv-1", "nm": "Bulk SMS", "ds": "Bulk messaging", "type": "sms", "status": "active"},
+        "Ticket": {"id": "t-1", "user_id": "u-1", "ds": "Cannot log in", "status": "open", "resolved_dt": None},
+        "Payment": {"id": "p-1", "user_id": "u-1", "amount": 1500.0, "currency": "KES", "status": "completed"},
+        "Profile": {"id": "pr-1", "user_id": "u-1", "full_nm": "Jane Wanjiku", "address": "Nairobi"},
+        "Permission": {"id": "pm-1", "nm": "send_sms", "ds": "Can send campaigns"},
+        "Order": {"id": "o-1", "user_id": "u-1", "service_id": "sv-1", "amount": 1500.0, "status": "completed"},
+        "Support": {"id": "su-1", "user_id": "u-1", "ds": "Invoice query", "category": "billing", "status": "open"},
+    }
+
+def bench_serialization(docs: int, rounds: int):
+    import main
+
+    now = datetime.utcnow()
+    print(f"{'docs/s':<20} {'validate + json':>18} {'TypeAdapter':>18} {'trusted orjson':>18}")
+    for name, sample in sample_documents(now).items():
+        model = getattr(main, name)
+        codec = main.CODECS[model]
+        page_adapter = main.TypeAdapter(list[model])
+        batch = [dict(sample, _id=ObjectId(), created_dt=now, id_mongo=None) for _ in range(docs)]
+
+        def legacy():
+            # What the handlers did before: mutate, validate through the response model, stdlib encode
+            items = [main.to_response(dict(doc)) for doc in batch]
+            json.dumps([model.model_validate(item).model_dump(mode="json") for item in items])
+
+        def adapter():
+            items = [main.to_response(dict(doc)) for doc in batch]
+            page_adapter.dump_json(page_adapter.validate_python(items))
+
+        def trusted():
+            main.ORJSONResponse([codec.trusted(main.to_response(dict(doc))) for doc in batch]).body
+
+        rates = []
+        for run in (legacy, adapter, trusted):
+            started = time.perf_counter()
+            for _ in range(rounds):
+                run()
+            rates.append(docs * rounds / (time.perf_counter() - started))
+        print(f"{name:<20} {rates[0]:>18.0f} {rates[1]:>18.0f} {rates[2]:>18.0f}")
+
+def bench_templates(messages: int, batch_size: int):
+    import main
+
+    text = "Hi {full_nm|there}, your {nm} balance alert: reply STOP to opt out. Ref {phone_nb}"
+    names = ["Jane Wanjiku", "Otieno Odhiambo", "Zoë Kamau", "Achieng", None]
+    contexts = [
+        {"full_nm": names[i % len(names)], "nm": "Acme", "phone_nb": f"+2547{i % 100000000:08d}"}
+        for i in range(batch_size)
+    ]
+    gsm7 = set(main.GSM7_BASIC + main.GSM7_EXTENDED)
+
+    def naive(context: dict):
+        # Per message regex substitution and a character-by-character encoding scan
+        message = main.PLACEHOLDER_RE.sub(lambda m: str(context.get(m.group(1)) or m.group(2) or ""), text)
+        if all(ch in gsm7 for ch in message):
+            length = len(message) + sum(ch in main.GSM7_EXTENDED for ch in message)
+            return message, "gsm7", main.segment_count("gsm7", length)
+        return message, "ucs2", main.segment_count("ucs2", len(message.encode("utf-16-le")) // 2)
+
+    template = main.compile_template(text)
+    assert template.render_batch(contexts) == [naive(context) for context in contexts]
+    batches = max(1, messages // batch_size)
+
+    started = time.perf_counter()
+    for _ in range(batches):
+        [naive(context) for context in contexts]
+    report("naive render + encoding scan", batches * batch_size, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(batches):
+        main.compile_template(text).render_batch(contexts)
+    report(f"compiled template batch={batch_size}", batches * batch_size, time.perf_counter() - started)
+
+def bench_suppression(suppressed: int, recipients: int, duplicate_rate: float):
+    import main
+    from array import array
+
+    # Kenyan mobile range, so suppressed numbers and the audience overlap like real traffic
+    space = 100000000
+    opted_out = sorted(random.sample(range(space), suppressed))
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    exact_set = {254700000000 + n for n in opted_out}
+    set_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    del exact_set
+    baseline = tracemalloc.get_traced_memory()[0]
+    numbers = array("Q", (254700000000 + n for n in opted_out))
+    array_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    print(f"{suppressed} suppressed numbers: python set {set_bytes / 2**20:8.1f} MiB, sorted uint64 array {array_bytes / 2**20:8.1f} MiB")
+
+    main.suppression_list.numbers = numbers
+    unique = int(recipients * (1 - duplicate_rate))
+    audience = [f"+2547{random.randrange(space):08d}" for _ in range(unique)]
+    audience += random.choices(audience, k=recipients - unique)
+    random.shuffle(audience)
+
+    # Campaign dedup: a set of every number seen against the merged sorted array dispatch keeps
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    seen = {main.normalize_msisdn(phone_nb) for phone_nb in audience}
+    seen_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    del seen
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    deduped = main.unique_numbers(audience, {"invalid": 0, "duplicates": 0})
+    dedup_bytes = tracemalloc.get_traced_memory()[0] - baseline
+    dedup_peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    del deduped
+    print(f"{recipients} audience numbers: python set {seen_bytes / 2**20:8.1f} MiB, "
+          f"sorted uint64 array {dedup_bytes / 2**20:8.1f} MiB (peak while merging {dedup_peak / 2**20:8.1f} MiB)")
+
+    counts = {"invalid": 0, "duplicates": 0, "suppressed": 0}
+    started = time.perf_counter()
+    kept = [msisdn for msisdn in main.unique_numbers(audience, counts) if msisdn not in main.suppression_list]
+    counts["suppressed"] = len(audience) - counts["invalid"] - counts["duplicates"] - len(kept)
+    report("dedup + suppression filter", recipients, time.perf_counter() - started)
+    print(f"kept {len(kept)}, dropped {counts}")
+
+# Credit ledger: parallel dispatch workers reserving from one prepaid account must never overdraw it
+LEDGER_COLLECTIONS = ("credit_account", "credit_ledger", "payment", "order", "scheduler", "campaign")
+
+def bind_ledger_collections(main):
+    for name in LEDGER_COLLECTIONS:
+        setattr(main.Collections, name, main.client[BENCH_DB][name])
+
+def ledger_worker(worker: int, tasks: int, batches: int, batch_size: int, gateway_url: str) -> tuple:
+    import main
+
+    bind_ledger_collections(main)
+
+    async def job(balancer, task: int) -> tuple:
+        # One simulated scheduler job: billed and checkpointed through dispatch_batches like run_scheduler_job
+        billing = main.CreditReservation("bench-user", "bench-campaign", f"bench-{worker}-{task}:1")
+        checkpoint = main.DispatchCheckpoint()
+        samples = []
+        reserve = billing.reserve
+
+        async def timed_reserve(cost: int, segments: int, seq: int) -> bool:
+            started = time.perf_counter()
+            try:
+                return await reserve(cost, segments, seq)
+            finally:
+                samples.append(time.perf_counter() - started)
+
+        billing.reserve = timed_reserve
+
+        async def recipients():
+            for b in range(batches):
+                checkpoint.mark({"batch": b + 1}, {})
+                yield [f"+2547{(b * batch_size + i) % 10**8:08d}" for i in range(batch_size)]
+
+        await main.dispatch_batches(balancer, "bench-campaign", recipients(), "bench", billing, checkpoint)
+        charged, released = billing.charged, billing.released
+        await billing.close()
+        position = checkpoint.position.get("batch", 0)
+        # The resume point sits right before the first unfunded batch and nothing past it went out
+        assert checkpoint.sent + checkpoint.failed == position * batch_size, (checkpoint.state(), position)
+        assert billing.exhausted == (position < batches), (billing.exhausted, position)
+        assert charged == checkpoint.sent * main.SMS_SEGMENT_PRICE, (charged, checkpoint.sent)
+        assert released == checkpoint.failed * main.SMS_SEGMENT_PRICE, (released, checkpoint.failed)
+        return (checkpoint.sent, checkpoint.failed, billing.unfunded, charged, released), samples
+
+    async def run():
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=None), timeout=30.0) as http:
+            balancer = main.GatewayBalancer(http)
+            balancer.refresh(bench_gateways([gateway_url]))
+            started = time.perf_counter()
+            results = await asyncio.gather(*(job(balancer, t) for t in range(tasks)))
+            return [r[0] for r in results], [s for r in results for s in r[1]], time.perf_counter() - started
+
+    return asyncio.run(run())
+
+def bench_ledger(workers: int, tasks: int, batches: int, batch_size: int, funded: float, failure_rate: float):
+    import main
+
+    batch_cost = batch_size * main.SMS_SEGMENT_PRICE
+    demand = workers * tasks * batches * batch_cost
+    initial = int(demand * funded) // batch_cost * batch_cost
+
+    async def seed():
+        bind_ledger_collections(main)
+        for name in LEDGER_COLLECTIONS:
+            await getattr(main.Collections, name).drop()
+        for name in ("credit_account", "credit_ledger"):
+            await getattr(main.Collections, name).create_indexes(main.INDEXES[name])
+        await main.Collections.payment.insert_one(
+            {"id": "bench-payment", "user_id": "bench-user", "amount": initial / 100,
+             "currency": main.BILLING_CURRENCY, "status": "completed", "created_dt": datetime.utcnow()}
+        )
+        await main.adjust_credit("bench-user", initial)
+
+    async def verify():
+        account = await main.Collections.credit_account.find_one({"user_id": "bench-user"}, {"_id": 0})
+        return account, await main.reconcile_credits()
+
+    asyncio.run(seed())
+    procs, urls = start_fake_gateways([(0.0, failure_rate)])
+    try:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.starmap(ledger_worker, [(w, tasks, batches, batch_size, urls[0]) for w in range(workers)])
+    finally:
+        for proc in procs:
+            proc.terminate()
+    jobs = [job for r in results for job in r[0]]
+    samples = [s for r in results for s in r[1]]
+    elapsed = max(r[2] for r in results)
+    sent, failed, unfunded, charged, released = (sum(column) for column in zip(*jobs))
+
+    account, reconciled = asyncio.run(verify())
+    report(f"billed dispatch workers={workers} tasks={tasks}", sent + failed, elapsed)
+    report_latency("reserve incl. turn wait", samples)
+    # Failed batches return to the balance on close, so holds can exceed the initial credit; charges cannot
+    print(f"initial={initial} demand={demand} sent={sent} failed={failed} unfunded={unfunded} "
+          f"charged={charged} released={released}")
+    print(f"final balance={account['balance']} reserved={account['reserved']} reconcile={reconciled}")
+    assert charged <= initial, "charges exceeded the prepaid balance"
+    assert account["balance"] >= 0 and account["reserved"] == 0, account
+    assert account["balance"] + charged == initial, "balance does not match initial credit minus charges"
+    assert reconciled["drift"] == 0, reconciled
+    print("no overdraw, every job's checkpoint stops at its first unfunded batch, ledger agrees")
+
+# Fake SMS gateway: keep-alive HTTP/1.1 server with configurable latency and error rate
+class FakeGateway:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = 0
+                for line in head.split(b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                await reader.readexactly(length)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                self.requests += 1
+                status = b"503 Service Unavailable" if random.random() < self.error_rate else b"200 OK"
+                writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: application/json\r\nContent-Length: 2\r\n\r\n{}")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 0, ready=None):
+        server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        url = f"http://{host}:{server.sockets[0].getsockname()[1]}/send"
+        if ready is not None:
+            ready.put(url)
+        else:
+            print(f"fake gateway listening on {url}")
+        async with server:
+            await server.serve_forever()
+
+def run_fake_gateway(ready, latency: float, error_rate: float, port: int = 0):
+    asyncio.run(FakeGateway(latency, error_rate).serve(port=port, ready=ready))
+
+def start_fake_gateways(specs: list) -> tuple:
+    """Start one fake gateway process per (latency, error_rate) spec; returns (processes, urls)."""
+    ready = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=run_fake_gateway, args=(ready, *spec), daemon=True) for spec in specs]
+    for proc in procs:
+        proc.start()
+    return procs, [ready.get(timeout=10) for _ in procs]
+
+# Dispatch engine: messages/second per worker process and per core
+def bench_gateways(urls: list) -> list:
+    return [{"id": f"gw{i}", "api_endpoint": url, "api_key": "bench-key-0"} for i, url in enumerate(urls)]
+
+def dispatch_worker(gateways: list, messages: int, batch_size: int) -> tuple:
+    import main
+
+    async def run():
+        batches_total = messages // batch_size
+
+        async def batches():
+            for b in range(batches_total):
+                yield [f"+2547{(b * batch_size + i) % 10**8:08d}" for i in range(batch_size)]
+
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=None), timeout=30.0) as http:
+            balancer = main.GatewayBalancer(http)
+            balancer.refresh(gateways)
+            started = time.perf_counter()
+            sent, failed = await main.dispatch_batches(balancer, "bench", batches(), "benchmark message")
+            return sent, failed, time.perf_counter() - started, balancer.snapshot()
+
+    return asyncio.run(run())
+
+def bench_dispatch(gateways: int, workers: list, messages: int, batch_size: int, latency: float):
+    procs, urls = start_fake_gateways([(latency, 0.0)] * gateways)
+    try:
+        for n in workers:
+            with multiprocessing.Pool(n) as pool:
+                results = pool.starmap(dispatch_worker, [(bench_gateways(urls), messages // n, batch_size)] * n)
+            sent = sum(r[0] for r in results)
+            failed = sum(r[1] for r in results)
+            elapsed = max(r[2] for r in results)
+            per_worker = sum(r[0] / r[2] for r in results) / n
+            cores = min(n, os.cpu_count() or 1)
+            report(f"dispatch workers={n} gateways={gateways} failed={failed}", sent, elapsed)
+            print(f"{'':<45} {per_worker:12.1f} msg/s per worker {sent / elapsed / cores:12.1f} msg/s per core")
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+# Gateway balancer: traffic split and circuit breaking with slow and failing gateways
+def bench_balancer(messages: int, batch_size: int):
+    specs = [(0.001, 0.0), (0.001, 0.0), (0.05, 0.0), (0.001, 0.5)]
+    procs, urls = start_fake_gateways(specs)
+    try:
+        sent, failed, elapsed, stats = dispatch_worker(bench_gateways(urls), messages, batch_size)
+        report(f"balancer failed={failed}", sent, elapsed)
+        for (latency, error_rate), stat in zip(specs, stats):
+            print(
+                f"  {stat['gateway_id']} latency={latency * 1000:.0f}ms error_rate={error_rate:.1f}: "
+                f"sent={stat['sent']} failed={stat['failed']} avg_tps={stat['sent'] / elapsed:.1f} "
+                f"latency_ms={stat['latency_ms']} state={stat['state']}"
+            )
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    mongo = sub.add_parser("mongo", help="blocking vs async Mongo driver throughput")
+    mongo.add_argument("--clients", type=int, nargs="+", default=[1, 10, 50, 100])
+    mongo.add_argument("--requests", type=int, default=5000)
+
+    analytics = sub.add_parser("analytics", help="range query over rollup buckets vs raw receipts")
+    analytics.add_argument("--days", type=int, default=90)
+    analytics.add_argument("--receipts", type=int, default=1000000)
+    analytics.add_argument("--queries", type=int, default=20)
+
+    bulk = sub.add_parser("bulk", help="per-item vs bulk user endpoints")
+    bulk.add_argument("--records", type=int, default=10000)
+    bulk.add_argument("--batch-size", type=int, default=500)
+    bulk.add_argument("--concurrency", type=int, default=10)
+
+    cache = sub.add_parser("cache", help="reference data reads with and without the in-process cache")
+    cache.add_argument("--requests", type=int, default=5000)
+
+    ussd = sub.add_parser("ussd", help="per-hop USSD latency at increasing concurrent session counts")
+    ussd.add_argument("--sessions", type=int, nargs="+", default=[100, 1000, 10000])
+    ussd.add_argument("--hops", type=int, default=5)
+
+    otp = sub.add_parser("otp", help="OTP issue and single round trip verify throughput")
+    otp.add_argument("--users", type=int, default=10000)
+    otp.add_argument("--concurrency", type=int, default=50)
+
+    startup = sub.add_parser("startup", help="cold start time of a fresh worker process")
+    startup.add_argument("--runs", type=int, default=10)
+
+    serialization = sub.add_parser("serialization", help="response encoding per model: validated vs trusted")
+    serialization.add_argument("--docs", type=int, default=1000)
+    serialization.add_argument("--rounds", type=int, default=20)
+
+    templates = sub.add_parser("templates", help="personalised messages rendered per second")
+    templates.add_argument("--messages", type=int, default=1000000)
+    templates.add_argument("--batch-size", type=int, default=1000)
+
+    suppression = sub.add_parser("suppression", help="opt-out list memory and audience filtering throughput")
+    suppression.add_argument("--suppressed", type=int, default=1000000)
+    suppression.add_argument("--recipients", type=int, default=2000000)
+    suppression.add_argument("--duplicate-rate", type=float, default=0.1)
+
+    dispatch = sub.add_parser("dispatch", help="dispatch engine throughput against fake gateways")
+    dispatch.add_argument("--gateways", type=int, default=4)
+    dispatch.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    dispatch.add_argument("--messages", type=int, default=200000)
+    dispatch.add_argument("--batch-size", type=int, default=100)
+    dispatch.add_argument("--latency", type=float, default=0.0, help="fake gateway response delay (s)")
+
+    balancer = sub.add_parser("balancer", help="gateway selection with fast, slow and failing gateways")
+    balancer.add_argument("--messages", type=int, default=100000)
+    balancer.add_argument("--batch-size", type=int, default=100)
+
+    ledger = sub.add_parser("ledger", help="billed dispatch jobs against one prepaid account and a fake gateway")
+    ledger.add_argument("--workers", type=int, default=4)
+    ledger.add_argument("--tasks", type=int, default=50, help="concurrent jobs per worker process")
+    ledger.add_argument("--batches", type=int, default=200, help="batches each job tries to send")
+    ledger.add_argument("--batch-size", type=int, default=100, help="one-segment messages per batch")
+    ledger.add_argument("--funded", type=float, default=0.5, help="share of total demand covered by the balance")
+    ledger.add_argument("--failure-rate", type=float, default=0.05, help="gateway error rate; failed batches are refunded")
+
+    fake = sub.add_parser("fake-gateway", help="run a standalone fake SMS gateway")
+    fake.add_argument("--port", type=int, default=9000)
+    fake.add_argument("--latency", type=float, default=0.0)
+    fake.add_argument("--error-rate", type=float, default=0.0)
+
+    args = parser.parse_args()
+    if args.command == "mongo":
+        asyncio.run(bench_mongo(args.clients, args.requests))
+    elif args.command == "analytics":
+        asyncio.run(bench_analytics(args.days, args.receipts, args.queries))
+    elif args.command == "bulk":
+        asyncio.run(bench_bulk(args.records, args.batch_size, args.concurrency))
+    elif args.command == "cache":
+        asyncio.run(bench_cache(args.requests))
+    elif args.command == "ussd":
+        asyncio.run(bench_ussd(args.sessions, args.hops))
+    elif args.command == "otp":
+        asyncio.run(bench_otp(args.users, args.concurrency))
+    elif args.command == "startup":
+        bench_startup(args.runs)
+    elif args.command == "serialization":
+        bench_serialization(args.docs, args.rounds)
+    elif args.command == "templates":
+        bench_templates(args.messages, args.batch_size)
+    elif args.command == "suppression":
+        bench_suppression(args.suppressed, args.recipients, args.duplicate_rate)
+    elif args.command == "dispatch":
+        bench_dispatch(args.gateways, args.workers, args.messages, args.batch_size, args.latency)
+    elif args.command == "balancer":
+        bench_balancer(args.messages, args.batch_size)
+    elif args.command == "ledger":
+        bench_ledger(args.workers, args.tasks, args.batches, args.batch_size, args.funded, args.failure_rate)
+    elif args.command == "fake-gateway":
+        run_fake_gateway(None, args.latency, args.error_rate, args.port)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,301 @@
-from fastapi import FastAPI, HTTPException
-from pymongo import MongoClient
+import os
+import re
+import sys
+import csv
+import json
+import codecs
+import base64
+import uuid
+import hmac
+import hashlib
+import secrets
+import time
+import socket
+import asyncio
+import heapq
+import bisect
+import threading
+from array import array
+import argparse
+import logging
+import httpx
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from fastapi import Body, FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from pymongo import AsyncMongoClient, IndexModel, InsertOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from bson import ObjectId
-from pydantic import BaseModel, EmailStr, Field
-from typing import List, Optional
-from datetime import datetime
-from pymongo.collection import Collection
+from bson.errors import InvalidId
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter, field_validator
+from typing import List, Optional, Union
+from datetime import datetime, timedelta, timezone
+from pymongo.asynchronous.collection import AsyncCollection as Collection
 
-app = FastAPI()
-client = MongoClient("mongodb://localhost:27017/")
-db = client["sms_platform_v2"]
+try:
+    import orjson
+except ImportError:  # optional, responses fall back to the stdlib encoder
+    orjson = None
+
+# Connection settings; the client connects lazily on first use, so importing main needs no Mongo
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB = os.getenv("MONGO_DB", "sms_platform_v2")
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "30000"))
+# Connection pool sizing, one pool per worker process
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+# Indexes are normally applied by `python main.py ensure-indexes`; set to 1 for throwaway dev databases
+ENSURE_INDEXES_ON_STARTUP = os.getenv("ENSURE_INDEXES_ON_STARTUP", "0") == "1"
+# Creates rely on unique indexes to reject duplicates, so the API refuses to start without them;
+# set to 1 to skip the startup check and leave it to GET /health/ready
+ALLOW_MISSING_UNIQUE_INDEXES = os.getenv("ALLOW_MISSING_UNIQUE_INDEXES", "0") == "1"
+STARTUP_INDEX_CHECK_TIMEOUT = float(os.getenv("STARTUP_INDEX_CHECK_TIMEOUT", "5"))  # seconds
+
+logger = logging.getLogger("sms_platform")
+startup_timings = {"imported_at": None, "lifespan_s": None, "ready_at": None}
+
+# Metrics: kept in process memory and served as Prometheus text on GET /metrics
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_MAX_SECONDS = 60
+
+def format_labels(names: tuple, values: tuple) -> str:
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+class Histogram:
+    """Latency histogram per label set; bucket counts are stored per bucket and cumulated on render."""
+
+    def __init__(self, name: str, help: str, labels: tuple, buckets: tuple = METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, values: tuple, seconds: float):
+        series = self.series.get(values)
+        if series is None:
+            # One slot per bucket, +Inf, then sum and count
+            series = self.series[values] = [0] * (len(self.buckets) + 3)
+        series[bisect.bisect_left(self.buckets, seconds)] += 1
+        series[-2] += seconds
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, series in self.series.items():
+            labels = format_labels(self.labels, values)
+            total = 0
+            for le, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {total}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{labels}}} {series[-1]}")
+        return lines
+
+def render_gauge(name: str, help: str, labels: tuple, samples: list) -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for values, value in samples:
+        lines.append(f"{name}{{{format_labels(labels, values)}}} {value}" if labels else f"{name} {value}")
+    return lines
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times every Mongo command by collection and command name."""
+
+    def __init__(self):
+        self.inflight = {}
+        self.histogram = Histogram(
+            "mongo_command_duration_seconds", "Mongo command round trip time", ("collection", "command", "outcome")
+        )
+
+    def started(self, event):
+        target = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self.inflight[(event.request_id, event.connection_id)] = target if isinstance(target, str) else ""
+
+    def succeeded(self, event):
+        self.finish(event, "success")
+
+    def failed(self, event):
+        self.finish(event, "failure")
+
+    def finish(self, event, outcome: str):
+        collection = self.inflight.pop((event.request_id, event.connection_id), "")
+        self.histogram.observe((collection, event.command_name, outcome), event.duration_micros / 1e6)
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Open and checked-out connections per server, plus checkout wait times."""
+
+    def __init__(self):
+        self.open = Counter()
+        self.checked_out = Counter()
+        self.checkout_failures = Counter()
+        self.wait = Histogram("mongo_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection", ("address",))
+
+    def connection_created(self, event):
+        self.open["%s:%s" % event.address] += 1
+
+    def connection_closed(self, event):
+        self.open["%s:%s" % event.address] -= 1
+
+    def connection_checked_out(self, event):
+        address = "%s:%s" % event.address
+        self.checked_out[address] += 1
+        if event.duration is not None:
+            self.wait.observe((address,), event.duration)
+
+    def connection_checked_in(self, event):
+        self.checked_out["%s:%s" % event.address] -= 1
+
+    def connection_check_out_failed(self, event):
+        self.checkout_failures["%s:%s" % event.address] += 1
+
+    def pool_closed(self, event):
+        self.open.pop("%s:%s" % event.address, None)
+        self.checked_out.pop("%s:%s" % event.address, None)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def render(self) -> List[str]:
+        addresses = sorted(set(self.open) | set(self.checkout_failures))
+        labels = ("address",)
+        return (
+            render_gauge("mongo_pool_open_connections", "Open pooled connections", labels,
+                         [((address,), self.open[address]) for address in addresses])
+            + render_gauge("mongo_pool_checked_out_connections", "Connections currently in use", labels,
+                           [((address,), self.checked_out[address]) for address in addresses])
+            + render_gauge("mongo_pool_utilization", "Checked-out connections over maxPoolSize", labels,
+                           [((address,), self.checked_out[address] / MONGO_MAX_POOL_SIZE) for address in addresses])
+            + render_gauge("mongo_pool_checkout_failures", "Failed connection checkouts", labels,
+                           [((address,), self.checkout_failures[address]) for address in addresses])
+            + self.wait.render()
+        )
+
+class MetricsMiddleware:
+    """ASGI middleware timing each request by method, route template and status."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Route templates rather than raw paths keep label cardinality bounded
+            route = scope.get("route")
+            http_metrics.observe(
+                (scope["method"], route.path if route else "unmatched", status[0]), time.perf_counter() - started
+            )
+
+class SamplingProfiler:
+    """Samples the event loop thread's stack from a helper thread and counts folded stacks."""
+
+    def __init__(self):
+        self.samples = Counter()
+        self.running = False
+
+    def sample(self, thread_id: int, interval: float, deadline: float):
+        while self.running and time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+
+    async def profile(self, seconds: float, interval: float) -> Counter:
+        self.samples = Counter()
+        self.running = True
+        thread = threading.Thread(
+            target=self.sample, args=(threading.get_ident(), interval, time.monotonic() + seconds), daemon=True
+        )
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.running = False
+            thread.join()
+        return self.samples
+
+http_metrics = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")
+)
+command_metrics = CommandMetrics()
+pool_metrics = PoolMetrics()
+profiler = SamplingProfiler()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    if not OTP_SECRET:
+        raise RuntimeError("OTP_SECRET is not set; every API worker needs the same key to verify OTP codes")
+    if ENSURE_INDEXES_ON_STARTUP:
+        await ensure_indexes()
+    if not ALLOW_MISSING_UNIQUE_INDEXES:
+        try:
+            missing = await asyncio.wait_for(missing_unique_indexes(), STARTUP_INDEX_CHECK_TIMEOUT)
+        except (PyMongoError, asyncio.TimeoutError) as e:
+            # Mongo being down is not a reason to stay down; readiness keeps failing until it is checked
+            logger.warning("Could not check unique indexes at startup, GET /health/ready will: %r", e)
+        else:
+            if missing:
+                raise RuntimeError(f"{MISSING_INDEXES_MESSAGE}: {', '.join(missing)}")
+    tasks = [asyncio.create_task(dlr_buffer.run()), suppression_list.start()]
+    if CACHE_CHANGE_STREAMS:
+        tasks.append(asyncio.create_task(watch_cache_invalidations()))
+    startup_timings["lifespan_s"] = time.perf_counter() - started
+    startup_timings["ready_at"] = time.time()
+    logger.info(
+        "Startup ready in %.3fs (%.3fs after import)",
+        startup_timings["lifespan_s"],
+        startup_timings["ready_at"] - startup_timings["imported_at"],
+    )
+    yield
+    for task in tasks:
+        task.cancel()
+    try:
+        await dlr_buffer.flush()
+    except PyMongoError:
+        logger.exception("Final delivery report flush failed, %d receipts not stored", dlr_buffer.pending())
+    if otp_balancer is not None:
+        await otp_balancer.http.aclose()
+    await client.close()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+client = AsyncMongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    event_listeners=[command_metrics, pool_metrics],
+)
+db = client[MONGO_DB]
 
 class Collections:
     campaign: Collection = db["campaign"]
@@ -26,6 +313,87 @@ class Collections:
     permission: Collection = db["permission"]
     order: Collection = db["order"]
     support: Collection = db["support"]  # New collection
+    recipient: Collection = db["recipient"]
+    recipient_upload: Collection = db["recipient_upload"]
+    suppression: Collection = db["suppression"]
+    credit_account: Collection = db["credit_account"]
+    credit_ledger: Collection = db["credit_ledger"]
+    gateway_stat: Collection = db["gateway_stat"]
+    dlr: Collection = db["dlr"]
+    analytic_rollup: Collection = db["analytic_rollup"]
+    ussd_session: Collection = db["ussd_session"]
+
+# E.164 MSISDN rule shared by User.phone_nb and recipient uploads
+PHONE_NB_PATTERN = r"^\+[1-9]\d{1,14}$"
+PHONE_NB_RE = re.compile(PHONE_NB_PATTERN)
+
+# Message Templates
+# Placeholders and the document each one is read from; phone_nb always comes from the recipient
+TEMPLATE_FIELD_SOURCES = {"phone_nb": "recipient", "nm": "user", "email": "user", "full_nm": "profile", "address": "profile"}
+PLACEHOLDER_RE = re.compile(r"\{(\w+)(?:\|([^{}]*))?\}")
+# GSM 03.38 default alphabet; extended characters cost an escape septet each
+GSM7_BASIC = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED = "^{}\\[~]|€\f"
+GSM7_STRIP = str.maketrans("", "", GSM7_BASIC + GSM7_EXTENDED)
+GSM7_EXTENDED_STRIP = str.maketrans("", "", GSM7_EXTENDED)
+
+def segment_count(encoding: str, length: int) -> int:
+    # Concatenated parts lose room to the UDH: 153 septets or 67 UCS-2 characters each
+    single, part = (160, 153) if encoding == "gsm7" else (70, 67)
+    return 1 if length <= single else -(-length // part)
+
+class MessageTemplate:
+    """Template compiled once into a positional format string, e.g. "Hi {full_nm|there}".
+
+    The literal text is scanned for GSM-7 once; rendering only scans the substituted
+    values, so encoding and segment counts cost a couple of C-level str.translate calls.
+    """
+
+    def __init__(self, text: str, literal: bool = False):
+        parts, fields, position = [], [], 0
+        for match in () if literal else PLACEHOLDER_RE.finditer(text):
+            name = match.group(1)
+            if name not in TEMPLATE_FIELD_SOURCES:
+                raise ValueError(f"Unknown placeholder {{{name}}}, expected one of {', '.join(TEMPLATE_FIELD_SOURCES)}")
+            parts.append(text[position:match.start()].replace("{", "{{").replace("}", "}}"))
+            parts.append(f"{{{len(fields)}}}")
+            fields.append((name, match.group(2) or ""))
+            position = match.end()
+        parts.append(text[position:].replace("{", "{{").replace("}", "}}"))
+        static = text if literal else PLACEHOLDER_RE.sub("", text)
+        self.text = text
+        self.fields = fields
+        self.sources = {TEMPLATE_FIELD_SOURCES[name] for name, _ in fields}
+        self.format = "".join(parts).format
+        self.literal_gsm7 = not static.translate(GSM7_STRIP)
+        self.literal_septets = 2 * len(static) - len(static.translate(GSM7_EXTENDED_STRIP))
+        self.literal_units = len(static.encode("utf-16-le")) // 2
+
+    def render_batch(self, contexts: List[dict]) -> List[tuple]:
+        """(message, encoding, segments) per context, in order."""
+        if not self.fields:
+            rendered = self.format()
+            encoding = "gsm7" if self.literal_gsm7 else "ucs2"
+            length = self.literal_septets if self.literal_gsm7 else self.literal_units
+            return [(rendered, encoding, segment_count(encoding, length))] * len(contexts)
+        results = []
+        for context in contexts:
+            values = [str(context.get(name) or default) for name, default in self.fields]
+            joined = "".join(values)
+            if self.literal_gsm7 and not joined.translate(GSM7_STRIP):
+                length = self.literal_septets + 2 * len(joined) - len(joined.translate(GSM7_EXTENDED_STRIP))
+                results.append((self.format(*values), "gsm7", segment_count("gsm7", length)))
+            else:
+                length = self.literal_units + len(joined.encode("utf-16-le")) // 2
+                results.append((self.format(*values), "ucs2", segment_count("ucs2", length)))
+        return results
+
+@lru_cache(maxsize=1024)
+def compile_template(text: str, literal: bool = False) -> MessageTemplate:
+    return MessageTemplate(text, literal)
 
 # Pydantic Models with id_mongo instead of _id
 class Campaign(BaseModel):
@@ -36,9 +404,20 @@ class Campaign(BaseModel):
     end_dt: datetime = Field(..., description="Campaign end date")
     target_audience: List[str] = Field(..., min_items=1)
     status: str = Field(..., pattern="^(active|completed|scheduled)$")
+    user_id: Optional[str] = Field(None, description="Account billed for sends; a campaign without one is not dispatched")
+    message_tx: Optional[str] = Field(
+        None, max_length=1600, description="Message template with {placeholder|default} fields, ds is sent if unset"
+    )
     created_dt: datetime = Field(default_factory=datetime.utcnow)
     id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
 
+    @field_validator("message_tx")
+    @classmethod
+    def check_message_tx(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None:
+            compile_template(value)
+        return value
+
 class USSDService(BaseModel):
     cd: str = Field(..., pattern=r"^\*[0-9]+(\*[0-9]+)*#$", description="USSD code")
     ds: str = Field(..., max_length=200)
@@ -61,19 +440,47 @@ class Analytics(BaseModel):
     timestamp_dt: datetime = Field(default_factory=datetime.utcnow)
     id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
 
+class AnalyticsSeries(BaseModel):
+    campaign_id: str = Field(..., description="Reference to campaign")
+    granularity: str = Field(..., pattern="^(minute|hour|day)$")
+    from_dt: datetime = Field(...)
+    to_dt: datetime = Field(...)
+    buckets: List[Analytics] = Field(..., description="One entry per bucket with receipts, oldest first")
+    truncated: bool = Field(False, description="More buckets than limit in range; the newest are returned")
+    next_to_dt: Optional[datetime] = Field(None, description="Pass as 'to' with the same 'from' for older buckets")
+
 class OTPAuthentication(BaseModel):
     user_id: str = Field(..., description="Reference to user")
-    cd: str = Field(..., pattern=r"^[0-9]{6}$", description="6-digit OTP")
-    expiry_dt: datetime = Field(...)
+    cd: Optional[str] = Field(
+        None, pattern=r"^[0-9]{6}$", description="6-digit OTP, generated server-side and sent by SMS, never returned"
+    )
+    phone_nb: Optional[str] = Field(
+        None, pattern=PHONE_NB_PATTERN, description="User's registered number the OTP was sent to"
+    )
+    expiry_dt: Optional[datetime] = Field(None, description="Set by the server from a capped TTL")
     created_dt: datetime = Field(default_factory=datetime.utcnow)
     id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
 
+class OTPIssue(BaseModel):
+    user_id: str = Field(..., description="Reference to user")
+    phone_nb: str = Field(..., pattern=PHONE_NB_PATTERN, description="Must match the user's registered number")
+    ttl: int = Field(300, ge=30, le=3600, description="Seconds until the OTP expires")
+
+class OTPVerify(BaseModel):
+    user_id: str = Field(..., description="Reference to user")
+    cd: str = Field(..., pattern=r"^[0-9]{6}$", description="6-digit OTP")
+    phone_nb: Optional[str] = Field(None, pattern=PHONE_NB_PATTERN)
+
 class SMSGateway(BaseModel):
     id: str = Field(..., description="Unique gateway ID")
     nm: str = Field(..., max_length=100)
     api_endpoint: str = Field(..., description="Gateway API URL")
     api_key: str = Field(..., min_length=10)
     status: str = Field(..., pattern="^(active|inactive)$")
+    weight: float = Field(1.0, gt=0, description="Relative share of traffic")
+    tps: Optional[float] = Field(
+        None, gt=0, description="Max messages per second across all dispatch workers, unlimited if unset"
+    )
     created_dt: datetime = Field(default_factory=datetime.utcnow)
     id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
 
@@ -81,7 +488,7 @@ class User(BaseModel):
     id: str = Field(..., description="Unique user identifier")
     nm: str = Field(..., max_length=100)
     email: EmailStr = Field(...)
-    phone_nb: str = Field(..., pattern=r"^\+[1-9]\d{1,14}$")
+    phone_nb: str = Field(..., pattern=PHONE_NB_PATTERN)
     role: str = Field(..., pattern="^(admin|user)$")
     created_dt: datetime = Field(default_factory=datetime.utcnow)
     id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
@@ -92,7 +499,7 @@ class Scheduler(BaseModel):
     ds: str = Field(..., max_length=500)
     campaign_id: Optional[str] = Field(None, description="Reference to campaign")
     schedule_dt: datetime = Field(...)
-    status: str = Field(..., pattern="^(pending|completed|failed)$")
+    status: str = Field(..., pattern="^(pending|running|completed|failed|unfunded)$")
     created_dt: datetime = Field(default_factory=datetime.utcnow)
     id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
 
@@ -156,161 +563,1670 @@ class Support(BaseModel):  # New model
     created_dt: datetime = Field(default_factory=datetime.utcnow)
     id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
 
-# Create Indexes
-Collections.campaign.create_index([("id", 1)], unique=True)
-Collections.ussd_service.create_index([("cd", 1)], unique=True)
-Collections.shortcode.create_index([("cd", 1)], unique=True)
-Collections.analytic.create_index([("campaign_id", 1)])
-Collections.otp.create_index([("user_id", 1)])
-Collections.gateway.create_index([("id", 1)], unique=True)
-Collections.user.create_index([("id", 1)], unique=True)
-Collections.user.create_index([("email", 1)], unique=True)
-Collections.scheduler.create_index([("id", 1)], unique=True)
-Collections.service.create_index([("id", 1)], unique=True)
-Collections.ticket.create_index([("id", 1)], unique=True)
-Collections.payment.create_index([("id", 1)], unique=True)
-Collections.profile.create_index([("id", 1)], unique=True)
-Collections.permission.create_index([("id", 1)], unique=True)
-Collections.order.create_index([("id", 1)], unique=True)
-Collections.support.create_index([("id", 1)], unique=True)  # New index
+class Page(BaseModel):
+    items: List[dict] = Field(..., description="Documents, newest first")
+    next_cursor: Optional[str] = Field(None, description="Pass back as cursor for the next page")
+
+class BulkItemResult(BaseModel):
+    index: int = Field(..., description="Position in the request list")
+    key: str = Field(..., description="Natural key of the item (id or cd)")
+    status: str = Field(..., pattern="^(created|updated|deleted|duplicate|not_found|error)$")
+    id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
+    detail: Optional[str] = Field(None, description="Error message for failed items")
+
+class Recipient(BaseModel):
+    campaign_id: str = Field(..., description="Reference to campaign")
+    phone_nb: str = Field(..., pattern=PHONE_NB_PATTERN)
+    created_dt: datetime = Field(default_factory=datetime.utcnow)
+    id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
+
+class RecipientUpload(BaseModel):
+    upload_id: str = Field(..., description="Unique upload identifier")
+    campaign_id: str = Field(..., description="Reference to campaign")
+    status: str = Field(..., pattern="^(in_progress|completed|failed)$")
+    lines: int = Field(0, ge=0, description="Rows read so far")
+    accepted: int = Field(0, ge=0, description="Recipients inserted")
+    rejected: int = Field(0, ge=0, description="Rows failing E.164 validation")
+    duplicates: int = Field(0, ge=0, description="Numbers already on the campaign")
+    rejects: List[dict] = Field(default_factory=list, description="First rejected rows")
+    created_dt: datetime = Field(default_factory=datetime.utcnow)
+    updated_dt: datetime = Field(default_factory=datetime.utcnow)
+
+class DeliveryReport(BaseModel):
+    message_id: str = Field(..., description="Gateway message identifier")
+    campaign_id: str = Field(..., description="Reference to campaign")
+    phone_nb: str = Field(..., pattern=PHONE_NB_PATTERN)
+    status: str = Field(..., pattern="^(delivered|failed|expired|rejected|undelivered)$")
+    gateway_id: Optional[str] = Field(None, description="Reference to gateway")
+    error_cd: Optional[str] = Field(None, max_length=50)
+    timestamp_dt: datetime = Field(default_factory=datetime.utcnow)
+
+class Suppression(BaseModel):
+    phone_nb: str = Field(..., pattern=PHONE_NB_PATTERN)
+    reason: str = Field("manual", pattern="^(stop|manual|complaint)$")
+    shortcode_cd: Optional[str] = Field(None, description="Shortcode the opt-out arrived on")
+    created_dt: datetime = Field(default_factory=datetime.utcnow)
+    id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
+
+class InboundMessage(BaseModel):
+    phone_nb: str = Field(..., description="Sender MSISDN")
+    text: str = Field(..., max_length=1600)
+    received_dt: datetime = Field(default_factory=datetime.utcnow)
+
+class CreditAccount(BaseModel):
+    user_id: str = Field(..., description="Reference to user")
+    balance: int = Field(..., description="Spendable credit in minor currency units")
+    reserved: int = Field(0, ge=0, description="Credit held by batches in flight")
+    currency: str = Field(..., pattern="^[A-Z]{3}$")
+    updated_dt: Optional[datetime] = Field(None)
+
+class CreditLedgerEntry(BaseModel):
+    user_id: str = Field(..., description="Reference to user")
+    kind: str = Field(..., pattern="^(payment|order|sms)$")
+    ref_id: str = Field(..., description="Payment id, order id or scheduler job batch")
+    amount: int = Field(..., description="Signed minor currency units, credits positive")
+    campaign_id: Optional[str] = Field(None, description="Reference to campaign for sms charges")
+    segments: Optional[int] = Field(None, ge=0)
+    created_dt: datetime = Field(default_factory=datetime.utcnow)
+    id_mongo: Optional[str] = Field(None, description="MongoDB ObjectId")
+
+class GatewayStat(BaseModel):
+    gateway_id: str = Field(..., description="Reference to gateway")
+    worker_id: str = Field(..., description="Dispatch worker reporting the stats")
+    state: str = Field(..., pattern="^(closed|open|half_open)$", description="Circuit breaker state")
+    tps: float = Field(..., ge=0, description="Messages/s since the previous report")
+    tps_limit: Optional[float] = Field(None, description="This worker's share of the gateway tps limit")
+    latency_ms: float = Field(..., ge=0, description="Moving average send latency")
+    error_rate: float = Field(..., ge=0.0, le=1.0)
+    outstanding: int = Field(..., ge=0, description="Requests in flight")
+    sent: int = Field(..., ge=0)
+    failed: int = Field(..., ge=0)
+    updated_dt: datetime = Field(...)
+
+class RenderedMessage(BaseModel):
+    phone_nb: str = Field(...)
+    message_tx: str = Field(...)
+    encoding: str = Field(..., pattern="^(gsm7|ucs2)$")
+    segments: int = Field(..., ge=1)
+
+class MessageEstimate(BaseModel):
+    campaign_id: str = Field(..., description="Reference to campaign")
+    messages: int = Field(..., ge=0)
+    segments: int = Field(..., ge=0, description="Billable SMS parts")
+    gsm7_messages: int = Field(..., ge=0)
+    ucs2_messages: int = Field(..., ge=0)
+    duplicates: int = Field(0, ge=0, description="Repeated numbers removed before sending")
+    suppressed: int = Field(0, ge=0, description="Opted-out numbers removed before sending")
+    invalid: int = Field(0, ge=0, description="Numbers that are not valid E.164")
+
+class USSDRequest(BaseModel):
+    session_id: str = Field(..., min_length=1, max_length=100, description="Operator session identifier")
+    service_cd: str = Field(..., pattern=r"^\*[0-9]+(\*[0-9]+)*#$", description="Dialled USSD code")
+    phone_nb: str = Field(..., pattern=PHONE_NB_PATTERN)
+    text: str = Field("", max_length=182, description="Subscriber input, '*'-joined across hops or latest only")
+
+# Keyset pagination indexes: (sort field, _id) plus (filter, sort field, _id) per list filter
+LIST_INDEXES = {
+    "campaign": ("created_dt", ["status"]),
+    "ussd_service": ("created_dt", []),
+    "shortcode": ("created_dt", []),
+    "analytic": ("timestamp_dt", ["campaign_id"]),
+    "otp": ("created_dt", ["user_id"]),
+    "gateway": ("created_dt", ["status"]),
+    "user": ("created_dt", []),
+    "scheduler": ("created_dt", ["status", "campaign_id"]),
+    "service": ("created_dt", ["status"]),
+    "ticket": ("created_dt", ["status", "user_id"]),
+    "payment": ("created_dt", ["status", "user_id"]),
+    "profile": ("created_dt", ["user_id"]),
+    "permission": ("created_dt", []),
+    "order": ("created_dt", ["status", "user_id"]),
+    "support": ("created_dt", ["status", "user_id", "category"]),
+    "suppression": ("created_dt", ["reason"]),
+    "credit_ledger": ("created_dt", ["user_id"]),
+}
+
+# Index Registry: every index the app relies on, per Collections attribute
+ROLLUP_MINUTE_RETENTION_DAYS = int(os.getenv("ROLLUP_MINUTE_RETENTION_DAYS", "30"))
+
+INDEXES = {
+    "campaign": [IndexModel([("id", 1)], unique=True)],
+    "ussd_service": [IndexModel([("cd", 1)], unique=True)],
+    "shortcode": [IndexModel([("cd", 1)], unique=True)],
+    "gateway": [IndexModel([("id", 1)], unique=True)],
+    "user": [
+        IndexModel([("id", 1)], unique=True),
+        IndexModel([("email", 1)], unique=True),
+        IndexModel([("phone_nb", 1)]),
+    ],
+    "scheduler": [IndexModel([("id", 1)], unique=True), IndexModel([("status", 1), ("schedule_dt", 1)])],
+    "service": [IndexModel([("id", 1)], unique=True)],
+    "ticket": [IndexModel([("id", 1)], unique=True)],
+    "payment": [IndexModel([("id", 1)], unique=True)],
+    "profile": [IndexModel([("id", 1)], unique=True)],
+    "permission": [IndexModel([("id", 1)], unique=True)],
+    "order": [IndexModel([("id", 1)], unique=True)],
+    "support": [IndexModel([("id", 1)], unique=True)],
+    "recipient": [IndexModel([("campaign_id", 1), ("phone_nb", 1)], unique=True)],
+    "recipient_upload": [IndexModel([("upload_id", 1)], unique=True)],
+    "suppression": [IndexModel([("msisdn", 1)], unique=True)],
+    "credit_account": [IndexModel([("user_id", 1)], unique=True)],
+    "credit_ledger": [IndexModel([("kind", 1), ("ref_id", 1)], unique=True)],
+    "gateway_stat": [
+        IndexModel([("worker_id", 1), ("gateway_id", 1)], unique=True),
+        IndexModel([("gateway_id", 1), ("updated_dt", -1)]),
+    ],
+    "dlr": [
+        IndexModel([("message_id", 1), ("status", 1)], unique=True),
+        IndexModel([("rollup_id", 1)], partialFilterExpression={"rolled_up": False}),
+    ],
+    "otp": [IndexModel([("expiry_dt", 1)], expireAfterSeconds=0)],
+    "ussd_session": [
+        IndexModel([("session_id", 1)], unique=True),
+        IndexModel([("expire_dt", 1)], expireAfterSeconds=0),
+    ],
+    "analytic_rollup": [
+        IndexModel([("campaign_id", 1), ("granularity", 1), ("timestamp_dt", 1)], unique=True),
+        IndexModel(
+            [("timestamp_dt", 1)],
+            expireAfterSeconds=ROLLUP_MINUTE_RETENTION_DAYS * 86400,
+            partialFilterExpression={"granularity": "minute"},
+        ),
+    ],
+}
+for name, (sort_field, filters) in LIST_INDEXES.items():
+    INDEXES.setdefault(name, []).append(IndexModel([(sort_field, -1), ("_id", -1)]))
+    for field in filters:
+        INDEXES[name].append(IndexModel([(field, 1), (sort_field, -1), ("_id", -1)]))
+
+async def ensure_indexes() -> dict:
+    """Creates registry indexes missing by name, one round trip per collection; returns what was created."""
+    created = {}
+    for name, models in INDEXES.items():
+        collection = getattr(Collections, name)
+        existing = await collection.index_information()
+        missing = [model for model in models if model.document["name"] not in existing]
+        if missing:
+            created[name] = await collection.create_indexes(missing)
+    return created
+
+MISSING_INDEXES_MESSAGE = "Unique indexes missing, duplicates will not be rejected. Run `python main.py ensure-indexes`"
+unique_indexes_checked = False  # set once a check finds none missing; indexes are not dropped at runtime
+
+async def missing_unique_indexes() -> List[str]:
+    """Registry unique indexes absent from the database, as collection.index_name; one
+    listIndexes per collection, sent concurrently."""
+    global unique_indexes_checked
+    if unique_indexes_checked:
+        return []
+    names = [name for name, models in INDEXES.items() if any(model.document.get("unique") for model in models)]
+    existing = await asyncio.gather(*(getattr(Collections, name).index_information() for name in names))
+    missing = [
+        f"{name}.{model.document['name']}"
+        for name, indexes in zip(names, existing)
+        for model in INDEXES[name]
+        if model.document.get("unique") and model.document["name"] not in indexes
+    ]
+    unique_indexes_checked = not missing
+    return missing
+
+# Response Serialization
+# Documents written through the models are encoded as read; set to 0 to validate every response
+TRUSTED_READS = os.getenv("TRUSTED_READS", "1") == "1"
+
+def bson_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        if orjson is None:
+            return json.dumps(content, default=bson_default, separators=(",", ":")).encode()
+        return orjson.dumps(content, default=bson_default, option=orjson.OPT_NON_STR_KEYS)
+
+class ResponseCodec:
+    """Serializer for one response model, with its TypeAdapter built once at import."""
+
+    def __init__(self, model: type):
+        self.adapter = TypeAdapter(model)
+        self.fields = tuple(model.model_fields)
+
+    def trusted(self, doc: dict) -> Optional[dict]:
+        # None when a field is missing and only validation can fill in its default
+        try:
+            return {nm: doc[nm] for nm in self.fields}
+        except KeyError:
+            return None
+
+    def response(self, doc: dict) -> Response:
+        if TRUSTED_READS:
+            item = self.trusted(doc)
+            if item is not None:
+                return ORJSONResponse(item)
+        return Response(self.adapter.dump_json(self.adapter.validate_python(doc)), media_type="application/json")
+
+CODECS = {
+    model: ResponseCodec(model)
+    for model in (
+        Campaign,
+        USSDService,
+        Shortcode,
+        Analytics,
+        AnalyticsSeries,
+        OTPAuthentication,
+        SMSGateway,
+        User,
+        Scheduler,
+        Service,
+        Ticket,
+        Payment,
+        Profile,
+        Permission,
+        Order,
+        Support,
+        Suppression,
+        CreditAccount,
+        CreditLedgerEntry,
+        RecipientUpload,
+        GatewayStat,
+    )
+}
+
+def to_response(doc: dict) -> dict:
+    doc["id_mongo"] = str(doc.pop("_id"))
+    return doc
+
+# Keyset Pagination
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 500
+
+def encode_cursor(doc: dict, sort_field: str) -> str:
+    raw = json.dumps([doc[sort_field].isoformat(), str(doc["_id"])])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        sort_value, oid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(sort_value), ObjectId(oid)
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def list_documents(
+    collection: Collection,
+    model: type,
+    filters: dict,
+    cursor: Optional[str],
+    limit: int,
+    fields: Optional[str],
+    sort_field: str = "created_dt",
+):
+    # Newest first on (sort_field, _id); the cursor resumes strictly after the last
+    # item returned, so every page is one index range scan however deep it is
+    query = {key: value for key, value in filters.items() if value is not None}
+    if cursor:
+        sort_value, oid = decode_cursor(cursor)
+        query["$or"] = [{sort_field: {"$lt": sort_value}}, {sort_field: sort_value, "_id": {"$lt": oid}}]
+    projection = None
+    if fields:
+        names = {nm.strip() for nm in fields.split(",") if nm.strip()}
+        unknown = names - set(model.model_fields)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+        projection = {nm: 1 for nm in names - {"id_mongo"}} | {sort_field: 1}
+    docs = await (
+        collection.find(query, projection).sort([(sort_field, -1), ("_id", -1)]).limit(limit + 1).to_list(None)
+    )
+    next_cursor = encode_cursor(docs[limit - 1], sort_field) if len(docs) > limit else None
+    fields = model.model_fields
+    items = [{nm: value for nm, value in to_response(doc).items() if nm in fields} for doc in docs[:limit]]
+    return ORJSONResponse({"items": items, "next_cursor": next_cursor})
+
+# Reference Data Cache
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))  # seconds, 0 disables caching
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_CHANGE_STREAMS = os.getenv("CACHE_CHANGE_STREAMS", "0") == "1"
+
+class TTLCache:
+    """LRU cache of response documents by natural key, each entry expiring after ttl seconds."""
+
+    def __init__(self, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.keys_by_oid = {}
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        doc, expires = entry
+        if expires <= time.monotonic():
+            self.discard(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return dict(doc)
+
+    def set(self, key: str, doc: dict):
+        if self.ttl <= 0:
+            return
+        self.discard(key)
+        self.entries[key] = (dict(doc), time.monotonic() + self.ttl)
+        self.keys_by_oid[doc["id_mongo"]] = key
+        while len(self.entries) > self.max_entries:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, key: str) -> bool:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.keys_by_oid.pop(entry[0]["id_mongo"], None)
+        return entry is not None
+
+    def invalidate(self, *keys: str):
+        for key in keys:
+            self.invalidations += self.discard(key)
+
+    def invalidate_oid(self, oid: str):
+        key = self.keys_by_oid.get(oid)
+        if key is not None:
+            self.invalidate(key)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.keys_by_oid.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+# One cache per cached collection, named after the Collections attribute
+class Caches:
+    gateway = TTLCache()
+    shortcode = TTLCache()
+    ussd_service = TTLCache()
+    service = TTLCache()
+
+def cache_for(collection: Collection) -> Optional[TTLCache]:
+    return getattr(Caches, collection.name, None)
+
+async def cached_find_one(collection: Collection, key: str, value: str) -> Optional[dict]:
+    cache = cache_for(collection)
+    doc = cache.get(value)
+    if doc is None:
+        doc = await collection.find_one({key: value})
+        if doc is None:
+            return None
+        cache.set(value, to_response(doc))
+    return doc
+
+async def watch_cache_invalidations():
+    # Keeps caches coherent across worker processes; needs a replica set or sharded cluster
+    names = [nm for nm, cache in vars(Caches).items() if isinstance(cache, TTLCache)]
+    pipeline = [{"$match": {"ns.coll": {"$in": names}}}]
+    while True:
+        try:
+            async with await db.watch(pipeline) as stream:
+                async for change in stream:
+                    cache = getattr(Caches, change["ns"]["coll"])
+                    if "documentKey" in change:
+                        cache.invalidate_oid(str(change["documentKey"]["_id"]))
+                    else:
+                        cache.clear()
+        except PyMongoError:
+            # Events may have been missed while disconnected
+            for nm in names:
+                getattr(Caches, nm).clear()
+            await asyncio.sleep(1.0)
+
+@app.get("/health/")
+async def health():
+    return {"status": "ok", "startup": startup_timings}
+
+@app.get("/health/ready")
+async def ready():
+    # Readiness, not liveness: a worker without Mongo or its unique indexes should get no traffic
+    try:
+        missing = await missing_unique_indexes()
+    except PyMongoError as e:
+        raise HTTPException(status_code=503, detail=f"MongoDB unavailable: {e}")
+    if missing:
+        raise HTTPException(status_code=503, detail=f"{MISSING_INDEXES_MESSAGE}: {', '.join(missing)}")
+    return {"status": "ready"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    lines = http_metrics.render() + command_metrics.histogram.render() + pool_metrics.render()
+    lines += render_gauge(
+        "cache_stats", "Reference data cache size and counters", ("cache", "event"),
+        [
+            ((nm, event), value)
+            for nm, cache in vars(Caches).items() if isinstance(cache, TTLCache)
+            for event, value in cache.stats().items()
+        ],
+    )
+    lines += render_gauge("dlr_buffered_reports", "Delivery reports waiting for the next flush", (),
+                          [((), dlr_buffer.pending())])
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+@app.post("/debug/profile", response_class=PlainTextResponse)
+async def run_profiler(
+    seconds: float = Query(10, gt=0, le=PROFILER_MAX_SECONDS),
+    interval: float = Query(0.005, ge=0.001, le=1),
+    top: int = Query(50, ge=1, le=1000),
+):
+    # Folded stacks, one "frame;frame;... count" per line, ready for flamegraph.pl or speedscope
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler disabled, set PROFILER_ENABLED=1")
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="Profiler already running")
+    samples = await profiler.profile(seconds, interval)
+    return "\n".join(f"{stack} {count}" for stack, count in samples.most_common(top)) + "\n"
+
+@app.get("/cache-stats/")
+async def read_cache_stats():
+    return {nm: cache.stats() for nm, cache in vars(Caches).items() if isinstance(cache, TTLCache)}
+
+# Bulk Writes
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "1000"))
+
+def check_bulk_size(items: list):
+    if not items:
+        raise HTTPException(status_code=400, detail="No items given")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} items per request")
+
+def bulk_write_errors(e: BulkWriteError) -> dict:
+    return {error["index"]: error for error in e.details["writeErrors"]}
+
+def bulk_error_result(index: int, key: str, error: dict) -> dict:
+    if error["code"] == 11000:
+        return {"index": index, "key": key, "status": "duplicate", "detail": error["errmsg"]}
+    return {"index": index, "key": key, "status": "error", "detail": error["errmsg"]}
+
+async def bulk_create(collection: Collection, key: str, items: list) -> list:
+    # One unordered round trip; the unique indexes reject duplicates per item
+    check_bulk_size(items)
+    docs = [item.model_dump(exclude={"id_mongo"}) for item in items]
+    errors = {}
+    try:
+        await collection.bulk_write([InsertOne(doc) for doc in docs], ordered=False)
+    except BulkWriteError as e:
+        errors = bulk_write_errors(e)
+    results = []
+    for index, doc in enumerate(docs):
+        if index in errors:
+            results.append(bulk_error_result(index, doc[key], errors[index]))
+        else:
+            results.append({"index": index, "key": doc[key], "status": "created", "id_mongo": str(doc["_id"])})
+    return results
+
+async def bulk_update(collection: Collection, key: str, items: list) -> list:
+    """One unordered write, then one read of the written keys for their _ids, as a bulk write only
+    reports how many updates matched. The read is trusted while it agrees with that match count;
+    a batch where nothing matched skips it."""
+    check_bulk_size(items)
+    docs = [item.model_dump(exclude={"id_mongo"}) for item in items]
+    errors = {}
+    try:
+        matched = (
+            await collection.bulk_write([UpdateOne({key: doc[key]}, {"$set": doc}) for doc in docs], ordered=False)
+        ).matched_count
+    except BulkWriteError as e:
+        errors = bulk_write_errors(e)
+        matched = e.details["nMatched"]
+    if cache_for(collection):
+        cache_for(collection).invalidate(*(doc[key] for doc in docs))
+    written = [index for index in range(len(docs)) if index not in errors]
+    found = {}
+    if matched:
+        cursor = collection.find({key: {"$in": [docs[index][key] for index in written]}}, {key: 1})
+        found = {doc[key]: str(doc["_id"]) async for doc in cursor}
+    updated = {index for index in written if docs[index][key] in found}
+    if len(updated) != matched:
+        # Keys were created or deleted between the write and the read, so the read cannot say which matched
+        for index in written:
+            errors[index] = {"code": None, "errmsg": "Changed concurrently; read the item to confirm the update"}
+    results = []
+    for index, doc in enumerate(docs):
+        if index in errors:
+            results.append(bulk_error_result(index, doc[key], errors[index]))
+        elif index in updated:
+            results.append({"index": index, "key": doc[key], "status": "updated", "id_mongo": found[doc[key]]})
+        else:
+            results.append({"index": index, "key": doc[key], "status": "not_found"})
+    return results
+
+async def bulk_delete(collection: Collection, key: str, keys: List[str]) -> list:
+    """Two round trips by design: a deleted document cannot be read back, so the keys are resolved
+    to _ids first and the delete targets those _ids. An item is reported deleted only if its
+    document was found and is gone afterwards; a key created in between is left alone."""
+    check_bulk_size(keys)
+    cursor = collection.find({key: {"$in": keys}}, {key: 1})
+    found = {doc[key]: str(doc["_id"]) async for doc in cursor}
+    if found:
+        await collection.delete_many({"_id": {"$in": [ObjectId(value) for value in found.values()]}})
+        if cache_for(collection):
+            cache_for(collection).invalidate(*found)
+    return [
+        {"index": index, "key": value, "status": "deleted", "id_mongo": found[value]}
+        if value in found
+        else {"index": index, "key": value, "status": "not_found"}
+        for index, value in enumerate(keys)
+    ]
 
 # Campaign Endpoints
 @app.post("/campaigns/", response_model=Campaign)
 async def create_campaign(campaign: Campaign):
     campaign_dict = campaign.model_dump()
-    if Collections.campaign.find_one({"id": campaign.id}):
+    try:
+        result = await Collections.campaign.insert_one(campaign_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Campaign ID already exists")
-    result = Collections.campaign.insert_one(campaign_dict)
     campaign.id_mongo = str(result.inserted_id)
     return campaign
 
+@app.get("/campaigns/", response_model=Page)
+async def list_campaigns(
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.campaign, Campaign, {"status": status}, cursor, limit, fields)
+
+# Bulk routes must be registered before the "/{id}" routes or "bulk" would match as an id
+@app.post("/campaigns/bulk", response_model=List[BulkItemResult])
+async def bulk_create_campaigns(items: List[Campaign]):
+    return await bulk_create(Collections.campaign, "id", items)
+
+@app.put("/campaigns/bulk", response_model=List[BulkItemResult])
+async def bulk_update_campaigns(items: List[Campaign]):
+    return await bulk_update(Collections.campaign, "id", items)
+
+@app.delete("/campaigns/bulk", response_model=List[BulkItemResult])
+async def bulk_delete_campaigns(keys: List[str] = Body(...)):
+    return await bulk_delete(Collections.campaign, "id", keys)
+
 @app.get("/campaigns/{id}", response_model=Campaign)
 async def read_campaign(id: str):
-    campaign = Collections.campaign.find_one({"id": id})
+    campaign = await Collections.campaign.find_one({"id": id})
     if campaign:
-        campaign["id_mongo"] = str(campaign.pop("_id"))
-        return campaign
+        return CODECS[Campaign].response(to_response(campaign))
     raise HTTPException(status_code=404, detail="Campaign not found")
 
 @app.put("/campaigns/{id}", response_model=Campaign)
 async def update_campaign(id: str, campaign: Campaign):
     campaign_dict = campaign.model_dump(exclude={"id_mongo"})
-    result = Collections.campaign.update_one({"id": id}, {"$set": campaign_dict})
-    if result.matched_count:
-        campaign.id_mongo = str(Collections.campaign.find_one({"id": id})["_id"])
+    result = await Collections.campaign.find_one_and_update(
+        {"id": id}, {"$set": campaign_dict}, projection={"_id": 1}
+    )
+    if result:
+        campaign.id_mongo = str(result["_id"])
         return campaign
     raise HTTPException(status_code=404, detail="Campaign not found")
 
 @app.delete("/campaigns/{id}")
 async def delete_campaign(id: str):
-    result = Collections.campaign.delete_one({"id": id})
+    result = await Collections.campaign.delete_one({"id": id})
     if result.deleted_count:
         return {"message": "Campaign deleted"}
     raise HTTPException(status_code=404, detail="Campaign not found")
 
+# Campaign Recipient Endpoints
+RECIPIENT_BATCH_SIZE = int(os.getenv("RECIPIENT_BATCH_SIZE", "1000"))
+RECIPIENT_MAX_REJECTS = 100  # rejected rows kept on the upload record
+RECIPIENT_CSV_COLUMNS = ("phone_nb", "msisdn")
+
+async def iter_upload_lines(request: Request):
+    # Split the body into lines as chunks arrive instead of buffering the file
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+def parse_recipient_line(line: str, fmt: str, column: int) -> str:
+    if fmt == "ndjson":
+        row = json.loads(line)
+        return str(row.get("phone_nb", "") if isinstance(row, dict) else row).strip()
+    return next(csv.reader([line]))[column].strip()
+
+async def flush_recipient_batch(upload_id: str, batch: list, line_nbs: list, rejects: list, lines: int):
+    accepted, duplicates = len(batch), 0
+    if batch:
+        try:
+            await Collections.recipient.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            accepted = e.details["nInserted"]
+            for error in e.details["writeErrors"]:
+                if error["code"] == 11000:
+                    duplicates += 1
+                else:
+                    rejects.append({"line": line_nbs[error["index"]], "reason": error["errmsg"]})
+    await Collections.recipient_upload.update_one(
+        {"upload_id": upload_id},
+        {
+            "$inc": {"lines": lines, "accepted": accepted, "duplicates": duplicates, "rejected": len(rejects)},
+            "$push": {"rejects": {"$each": rejects, "$slice": RECIPIENT_MAX_REJECTS}},
+            "$set": {"updated_dt": datetime.utcnow()},
+        },
+    )
+
+@app.post("/campaigns/{id}/recipients", response_model=RecipientUpload)
+async def upload_recipients(id: str, request: Request, upload_id: Optional[str] = None):
+    if not await Collections.campaign.find_one({"id": id}, {"_id": 1}):
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    upload = RecipientUpload(upload_id=upload_id or uuid.uuid4().hex, campaign_id=id, status="in_progress")
+    try:
+        await Collections.recipient_upload.insert_one(upload.model_dump())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Upload ID already exists")
+
+    fmt = "ndjson" if "json" in request.headers.get("content-type", "") else "csv"
+    column, header_checked = 0, fmt != "csv"
+    batch, line_nbs, rejects, lines, line_nb = [], [], [], 0, 0
+    try:
+        async for line in iter_upload_lines(request):
+            line_nb += 1
+            lines += 1
+            if not line.strip():
+                continue
+            if not header_checked:
+                header_checked = True
+                cells = [cell.strip().lower() for cell in next(csv.reader([line]))]
+                header = [nm for nm in RECIPIENT_CSV_COLUMNS if nm in cells]
+                if header:
+                    column = cells.index(header[0])
+                    continue
+            try:
+                phone_nb = parse_recipient_line(line, fmt, column)
+            except (ValueError, IndexError):
+                phone_nb = ""
+            if PHONE_NB_RE.fullmatch(phone_nb):
+                batch.append({"campaign_id": id, "phone_nb": phone_nb, "created_dt": datetime.utcnow()})
+                line_nbs.append(line_nb)
+            else:
+                rejects.append({"line": line_nb, "reason": "invalid E.164 number", "value": line[:64]})
+            if lines >= RECIPIENT_BATCH_SIZE:
+                await flush_recipient_batch(upload.upload_id, batch, line_nbs, rejects, lines)
+                batch, line_nbs, rejects, lines = [], [], [], 0
+        await flush_recipient_batch(upload.upload_id, batch, line_nbs, rejects, lines)
+    except Exception:
+        await Collections.recipient_upload.update_one(
+            {"upload_id": upload.upload_id}, {"$set": {"status": "failed", "updated_dt": datetime.utcnow()}}
+        )
+        raise
+    return await Collections.recipient_upload.find_one_and_update(
+        {"upload_id": upload.upload_id},
+        {"$set": {"status": "completed", "updated_dt": datetime.utcnow()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER,
+    )
+
+@app.get("/campaigns/{id}/recipients/uploads/{upload_id}", response_model=RecipientUpload)
+async def read_recipient_upload(id: str, upload_id: str):
+    upload = await Collections.recipient_upload.find_one({"campaign_id": id, "upload_id": upload_id}, {"_id": 0})
+    if upload:
+        return CODECS[RecipientUpload].response(upload)
+    raise HTTPException(status_code=404, detail="Recipient upload not found")
+
+# Campaign Message Endpoints
+def campaign_template(campaign: dict) -> MessageTemplate:
+    # Campaigns without a template keep sending their description verbatim
+    if campaign.get("message_tx"):
+        return compile_template(campaign["message_tx"])
+    return compile_template(campaign["ds"], literal=True)
+
+async def load_template_contexts(template: MessageTemplate, phone_nbs: List[str]) -> List[dict]:
+    """Placeholder values per recipient: one $in read for users by number, one for their profiles."""
+    contexts = {phone_nb: {"phone_nb": phone_nb} for phone_nb in phone_nbs}
+    if template.sources & {"user", "profile"}:
+        users = await Collections.user.find(
+            {"phone_nb": {"$in": list(contexts)}}, {"_id": 0, "id": 1, "nm": 1, "email": 1, "phone_nb": 1}
+        ).to_list(None)
+        for user in users:
+            contexts[user["phone_nb"]].update(user)
+        if "profile" in template.sources and users:
+            by_user = {user["id"]: contexts[user["phone_nb"]] for user in users}
+            profiles = Collections.profile.find(
+                {"user_id": {"$in": list(by_user)}}, {"_id": 0, "user_id": 1, "full_nm": 1, "address": 1}
+            )
+            async for profile in profiles:
+                by_user[profile["user_id"]].update(profile)
+    return [contexts[phone_nb] for phone_nb in phone_nbs]
+
+async def render_recipients(template: MessageTemplate, phone_nbs: List[str]) -> List[tuple]:
+    if not template.fields:
+        return template.render_batch(phone_nbs)
+    return template.render_batch(await load_template_contexts(template, phone_nbs))
+
+async def find_campaign(id: str) -> dict:
+    campaign = await Collections.campaign.find_one({"id": id}, {"_id": 0})
+    if campaign is None:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return campaign
+
+@app.get("/campaigns/{id}/messages/preview", response_model=List[RenderedMessage])
+async def preview_campaign_messages(id: str, limit: int = Query(10, ge=1, le=LIST_MAX_LIMIT)):
+    campaign = await find_campaign(id)
+    template = campaign_template(campaign)
+    await require_suppression_list()
+    async for batch in iter_campaign_batches(campaign, size=limit):
+        return [
+            {"phone_nb": phone_nb, "message_tx": message, "encoding": encoding, "segments": segments}
+            for phone_nb, (message, encoding, segments) in zip(batch, await render_recipients(template, batch))
+        ]
+    return []
+
+@app.get("/campaigns/{id}/messages/estimate", response_model=MessageEstimate)
+async def estimate_campaign_messages(id: str):
+    # Renders every recipient in dispatch-sized batches, so the segment count is what will be billed
+    campaign = await find_campaign(id)
+    template = campaign_template(campaign)
+    await require_suppression_list()
+    estimate = {"campaign_id": id, "messages": 0, "segments": 0, "gsm7_messages": 0, "ucs2_messages": 0}
+    counts = {}
+    async for batch in iter_campaign_batches(campaign, counts=counts):
+        for _, encoding, segments in await render_recipients(template, batch):
+            estimate["segments"] += segments
+            estimate[f"{encoding}_messages"] += 1
+        estimate["messages"] += len(batch)
+    return {**estimate, **counts}
+
 # USSD Service Endpoints
 @app.post("/ussd-services/", response_model=USSDService)
 async def create_ussd_service(ussd_service: USSDService):
     ussd_dict = ussd_service.model_dump()
-    if Collections.ussd_service.find_one({"cd": ussd_service.cd}):
+    try:
+        result = await Collections.ussd_service.insert_one(ussd_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="USSD code already exists")
-    result = Collections.ussd_service.insert_one(ussd_dict)
     ussd_service.id_mongo = str(result.inserted_id)
     return ussd_service
 
+@app.get("/ussd-services/", response_model=Page)
+async def list_ussd_services(
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.ussd_service, USSDService, {}, cursor, limit, fields)
+
+@app.post("/ussd-services/bulk", response_model=List[BulkItemResult])
+async def bulk_create_ussd_services(items: List[USSDService]):
+    return await bulk_create(Collections.ussd_service, "cd", items)
+
+@app.put("/ussd-services/bulk", response_model=List[BulkItemResult])
+async def bulk_update_ussd_services(items: List[USSDService]):
+    return await bulk_update(Collections.ussd_service, "cd", items)
+
+@app.delete("/ussd-services/bulk", response_model=List[BulkItemResult])
+async def bulk_delete_ussd_services(keys: List[str] = Body(...)):
+    return await bulk_delete(Collections.ussd_service, "cd", keys)
+
 @app.get("/ussd-services/{cd}", response_model=USSDService)
 async def read_ussd_service(cd: str):
-    ussd = Collections.ussd_service.find_one({"cd": cd})
+    ussd = await cached_find_one(Collections.ussd_service, "cd", cd)
     if ussd:
-        ussd["id_mongo"] = str(ussd.pop("_id"))
-        return ussd
+        return CODECS[USSDService].response(ussd)
     raise HTTPException(status_code=404, detail="USSD Service not found")
 
 @app.put("/ussd-services/{cd}", response_model=USSDService)
 async def update_ussd_service(cd: str, ussd_service: USSDService):
     ussd_dict = ussd_service.model_dump(exclude={"id_mongo"})
-    result = Collections.ussd_service.update_one({"cd": cd}, {"$set": ussd_dict})
-    if result.matched_count:
-        ussd_service.id_mongo = str(Collections.ussd_service.find_one({"cd": cd})["_id"])
+    result = await Collections.ussd_service.find_one_and_update(
+        {"cd": cd}, {"$set": ussd_dict}, projection={"_id": 1}
+    )
+    Caches.ussd_service.invalidate(cd, ussd_service.cd)
+    if result:
+        ussd_service.id_mongo = str(result["_id"])
         return ussd_service
     raise HTTPException(status_code=404, detail="USSD Service not found")
 
 @app.delete("/ussd-services/{cd}")
 async def delete_ussd_service(cd: str):
-    result = Collections.ussd_service.delete_one({"cd": cd})
+    result = await Collections.ussd_service.delete_one({"cd": cd})
+    Caches.ussd_service.invalidate(cd)
     if result.deleted_count:
         return {"message": "USSD Service deleted"}
     raise HTTPException(status_code=404, detail="USSD Service not found")
 
+# USSD Session Engine
+USSD_SESSION_STORE = os.getenv("USSD_SESSION_STORE", "memory")  # memory | mongo
+USSD_INVALID_CHOICE = "Invalid choice"
+
+class USSDMenuNode:
+    """Menu screen with its response text rendered once at compile time."""
+
+    def __init__(self, label: str, reply: Optional[str] = None):
+        self.label = label
+        self.reply = reply
+        self.children = []
+        self.screen = ""
+        self.invalid_screen = ""
+
+class USSDMenu:
+    """Menu tree compiled from menu_options and indexed by '*'-joined selection path.
+
+    Each option is a '>'-separated path with an optional '=reply' on the leaf,
+    e.g. "Account>Balance=Your balance will be sent by SMS". Plain options are
+    top-level leaves, so existing flat menus keep working.
+    """
+
+    def __init__(self, title: str, menu_options: List[str], session_timeout: int):
+        self.session_timeout = session_timeout
+        self.root = USSDMenuNode(title)
+        for option in menu_options:
+            labels, _, reply = option.partition("=")
+            node = self.root
+            for label in (part.strip() for part in labels.split(">")):
+                child = next((c for c in node.children if c.label == label), None)
+                if child is None:
+                    child = USSDMenuNode(label)
+                    node.children.append(child)
+                node = child
+            node.reply = reply.strip() or node.reply
+        self.nodes = {}
+        self.index(self.root, "")
+
+    def index(self, node: USSDMenuNode, path: str):
+        self.nodes[path] = node
+        if not node.children:
+            node.screen = f"END {node.reply or node.label}"
+            return
+        lines = [node.label] + [f"{n}. {child.label}" for n, child in enumerate(node.children, 1)]
+        if path:
+            lines.append("0. Back")
+        node.screen = "CON " + "\n".join(lines)
+        node.invalid_screen = f"CON {USSD_INVALID_CHOICE}\n" + "\n".join(lines)
+        for n, child in enumerate(node.children, 1):
+            self.index(child, f"{path}*{n}" if path else str(n))
+
+    def step(self, path: str, choice: str) -> tuple:
+        """Returns (new path, screen); the path is None once a leaf ends the session."""
+        if choice == "0" and path:
+            path = path.rpartition("*")[0]
+            return path, self.nodes[path].screen
+        target = f"{path}*{choice}" if path else choice
+        node = self.nodes.get(target)
+        if node is None:
+            return path, self.nodes[path].invalid_screen
+        if not node.children:
+            return None, node.screen
+        return target, node.screen
+
+class USSDMenus:
+    """Compiled menus per service code, rebuilt only when the cached service document changes."""
+
+    menus = {}
+
+    @classmethod
+    async def get(cls, cd: str) -> Optional[USSDMenu]:
+        service = await cached_find_one(Collections.ussd_service, "cd", cd)
+        if service is None:
+            cls.menus.pop(cd, None)
+            return None
+        source = (service["ds"], tuple(service["menu_options"]), service["session_timeout"])
+        compiled = cls.menus.get(cd)
+        if compiled is None or compiled[0] != source:
+            compiled = cls.menus[cd] = (source, USSDMenu(*source))
+        return compiled[1]
+
+class MemoryUSSDSessionStore:
+    """Per-process session store; expiries sit in a heap and are reaped as sessions are written."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.expiries = []
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.sessions[session_id]
+            return None
+        return entry[0]
+
+    async def set(self, session_id: str, state: dict, ttl: int):
+        now = time.monotonic()
+        expires = now + ttl
+        self.sessions[session_id] = (state, expires)
+        heapq.heappush(self.expiries, (expires, session_id))
+        while self.expiries and self.expiries[0][0] <= now:
+            expired, key = heapq.heappop(self.expiries)
+            entry = self.sessions.get(key)
+            # Refreshed sessions leave stale heap entries behind, only drop the current expiry
+            if entry is not None and entry[1] == expired:
+                del self.sessions[key]
+
+    async def delete(self, session_id: str):
+        self.sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        return {"store": "memory", "sessions": len(self.sessions), "pending_expiries": len(self.expiries)}
+
+class MongoUSSDSessionStore:
+    """Shared session store for multi-worker deployments, expired by a TTL index on expire_dt."""
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        doc = await Collections.ussd_session.find_one(
+            {"session_id": session_id, "expire_dt": {"$gt": datetime.utcnow()}}, {"_id": 0, "state": 1}
+        )
+        return doc["state"] if doc else None
+
+    async def set(self, session_id: str, state: dict, ttl: int):
+        await Collections.ussd_session.update_one(
+            {"session_id": session_id},
+            {"$set": {"state": state, "expire_dt": datetime.utcnow() + timedelta(seconds=ttl)}},
+            upsert=True,
+        )
+
+    async def delete(self, session_id: str):
+        await Collections.ussd_session.delete_one({"session_id": session_id})
+
+    def stats(self) -> dict:
+        return {"store": "mongo"}
+
+USSD_SESSION_STORES = {"memory": MemoryUSSDSessionStore, "mongo": MongoUSSDSessionStore}
+ussd_sessions = USSD_SESSION_STORES[USSD_SESSION_STORE]()
+
+async def ussd_hop(request: USSDRequest) -> str:
+    menu = await USSDMenus.get(request.service_cd)
+    if menu is None:
+        raise HTTPException(status_code=404, detail="USSD Service not found")
+    state = await ussd_sessions.get(request.session_id)
+    if state is None or state["service_cd"] != request.service_cd:
+        # New or expired session: any input dialled with the code is ignored
+        state = {"service_cd": request.service_cd, "phone_nb": request.phone_nb, "path": ""}
+        path, screen = "", menu.root.screen
+        if not menu.root.children:
+            path = None
+    else:
+        path, screen = menu.step(state["path"], request.text.rpartition("*")[2].strip())
+    if path is None:
+        await ussd_sessions.delete(request.session_id)
+    else:
+        state["path"] = path
+        await ussd_sessions.set(request.session_id, state, menu.session_timeout)
+    return screen
+
+@app.post("/ussd/callback", response_class=PlainTextResponse)
+async def ussd_callback(request: USSDRequest):
+    return await ussd_hop(request)
+
+@app.get("/ussd/sessions/stats")
+async def ussd_session_stats():
+    return ussd_sessions.stats()
+
 # Shortcode Endpoints
 @app.post("/shortcodes/", response_model=Shortcode)
 async def create_shortcode(shortcode: Shortcode):
     shortcode_dict = shortcode.model_dump()
-    if Collections.shortcode.find_one({"cd": shortcode.cd}):
+    try:
+        result = await Collections.shortcode.insert_one(shortcode_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Shortcode already exists")
-    result = Collections.shortcode.insert_one(shortcode_dict)
     shortcode.id_mongo = str(result.inserted_id)
     return shortcode
 
+@app.get("/shortcodes/", response_model=Page)
+async def list_shortcodes(
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.shortcode, Shortcode, {}, cursor, limit, fields)
+
+@app.post("/shortcodes/bulk", response_model=List[BulkItemResult])
+async def bulk_create_shortcodes(items: List[Shortcode]):
+    return await bulk_create(Collections.shortcode, "cd", items)
+
+@app.put("/shortcodes/bulk", response_model=List[BulkItemResult])
+async def bulk_update_shortcodes(items: List[Shortcode]):
+    return await bulk_update(Collections.shortcode, "cd", items)
+
+@app.delete("/shortcodes/bulk", response_model=List[BulkItemResult])
+async def bulk_delete_shortcodes(keys: List[str] = Body(...)):
+    return await bulk_delete(Collections.shortcode, "cd", keys)
+
 @app.get("/shortcodes/{cd}", response_model=Shortcode)
 async def read_shortcode(cd: str):
-    short = Collections.shortcode.find_one({"cd": cd})
+    short = await cached_find_one(Collections.shortcode, "cd", cd)
     if short:
-        short["id_mongo"] = str(short.pop("_id"))
-        return short
+        return CODECS[Shortcode].response(short)
     raise HTTPException(status_code=404, detail="Shortcode not found")
 
 @app.put("/shortcodes/{cd}", response_model=Shortcode)
 async def update_shortcode(cd: str, shortcode_data: Shortcode):
     shortcode_dict = shortcode_data.model_dump(exclude={"id_mongo"})
-    result = Collections.shortcode.update_one({"cd": cd}, {"$set": shortcode_dict})
-    if result.matched_count:
-        shortcode_data.id_mongo = str(Collections.shortcode.find_one({"cd": cd})["_id"])
+    result = await Collections.shortcode.find_one_and_update(
+        {"cd": cd}, {"$set": shortcode_dict}, projection={"_id": 1}
+    )
+    Caches.shortcode.invalidate(cd, shortcode_data.cd)
+    if result:
+        shortcode_data.id_mongo = str(result["_id"])
         return shortcode_data
     raise HTTPException(status_code=404, detail="Shortcode not found")
 
 @app.delete("/shortcodes/{cd}")
 async def delete_shortcode(cd: str):
-    result = Collections.shortcode.delete_one({"cd": cd})
+    result = await Collections.shortcode.delete_one({"cd": cd})
+    Caches.shortcode.invalidate(cd)
     if result.deleted_count:
         return {"message": "Shortcode deleted"}
     raise HTTPException(status_code=404, detail="Shortcode not found")
 
+# Suppression List
+SUPPRESSION_REFRESH = float(os.getenv("SUPPRESSION_REFRESH", "60"))  # seconds between reloads from Mongo
+SUPPRESSION_RETRY = 2.0  # seconds between attempts until the first load succeeds
+SUPPRESSION_LOAD_TIMEOUT = float(os.getenv("SUPPRESSION_LOAD_TIMEOUT", "10"))  # seconds a reader waits for it
+DEDUP_CHUNK_SIZE = 65536  # numbers sorted at a time before the chunks are merged
+STOP_KEYWORDS = {"STOP", "STOPALL", "UNSUBSCRIBE", "CANCEL", "END", "QUIT"}
+START_KEYWORDS = {"START", "UNSTOP", "SUBSCRIBE"}
+
+def normalize_msisdn(phone_nb: str) -> Optional[int]:
+    # E.164 digits as an integer, so a number costs 8 bytes and compares without string work
+    phone_nb = phone_nb.strip()
+    if not PHONE_NB_RE.match(phone_nb):
+        phone_nb = re.sub(r"[\s().-]", "", phone_nb)
+        if phone_nb.startswith("00"):
+            phone_nb = "+" + phone_nb[2:]
+        if not PHONE_NB_RE.match(phone_nb):
+            return None
+    return int(phone_nb[1:])
+
+def contains(numbers: array, msisdn: int) -> bool:
+    index = bisect.bisect_left(numbers, msisdn)
+    return index < len(numbers) and numbers[index] == msisdn
+
+def unique_numbers(phone_nbs: List[str], counts: dict) -> array:
+    """Normalised numbers as a sorted, duplicate-free uint64 array, 8 bytes per number instead of
+    a set entry; invalid and repeated numbers are tallied in counts. Chunks are sorted on their
+    own and merged, so no per-number Python objects outlive a chunk."""
+    chunks, chunk = [], array("Q")
+    for phone_nb in phone_nbs:
+        msisdn = normalize_msisdn(phone_nb)
+        if msisdn is None:
+            counts["invalid"] += 1
+            continue
+        chunk.append(msisdn)
+        if len(chunk) == DEDUP_CHUNK_SIZE:
+            chunks.append(array("Q", sorted(chunk)))
+            chunk = array("Q")
+    chunks.append(array("Q", sorted(chunk)))
+    numbers, last = array("Q"), None
+    for msisdn in heapq.merge(*chunks):
+        if msisdn == last:
+            counts["duplicates"] += 1
+        else:
+            numbers.append(msisdn)
+            last = msisdn
+    return numbers
+
+class SuppressionList:
+    """Opted-out MSISDNs as a sorted uint64 array loaded from the suppression collection.
+
+    A background task started on first use reloads it every SUPPRESSION_REFRESH seconds, so
+    requests and dispatch never wait on a reload. Changes made by this process since the last
+    load sit in small added/removed sets, so a STOP takes effect here immediately and in other
+    workers on their next reload.
+    """
+
+    def __init__(self):
+        self.numbers = array("Q")
+        self.added = set()
+        self.removed = set()
+        self.loaded_at = None
+        self.loaded = asyncio.Event()
+        self.task = None
+
+    async def refresh(self):
+        added, removed = set(self.added), set(self.removed)
+        numbers = array("Q")
+        cursor = Collections.suppression.find({}, {"_id": 0, "msisdn": 1}).sort("msisdn", 1).batch_size(10000)
+        async for doc in cursor:
+            numbers.append(doc["msisdn"])
+        # Keep only the changes that raced with the load
+        self.numbers, self.loaded_at = numbers, time.monotonic()
+        self.added -= added
+        self.removed -= removed
+        self.loaded.set()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except PyMongoError as e:
+                logger.warning("Suppression list reload failed, keeping the previous copy: %s", e)
+            await asyncio.sleep(SUPPRESSION_REFRESH if self.loaded.is_set() else SUPPRESSION_RETRY)
+
+    def start(self) -> asyncio.Task:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return self.task
+
+    async def ready(self) -> bool:
+        # Only the first load is waited for, and only so long; later reloads swap the array in behind readers
+        self.start()
+        try:
+            await asyncio.wait_for(self.loaded.wait(), SUPPRESSION_LOAD_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def __contains__(self, msisdn: int) -> bool:
+        if msisdn in self.removed:
+            return False
+        if msisdn in self.added:
+            return True
+        return contains(self.numbers, msisdn)
+
+    def add(self, msisdn: int):
+        self.added.add(msisdn)
+        self.removed.discard(msisdn)
+
+    def remove(self, msisdn: int):
+        self.removed.add(msisdn)
+        self.added.discard(msisdn)
+
+    def stats(self) -> dict:
+        return {
+            "numbers": len(self.numbers),
+            "bytes": len(self.numbers) * self.numbers.itemsize,
+            "added": len(self.added),
+            "removed": len(self.removed),
+            "age_s": None if self.loaded_at is None else time.monotonic() - self.loaded_at,
+        }
+
+suppression_list = SuppressionList()
+
+async def require_suppression_list():
+    if not await suppression_list.ready():
+        raise HTTPException(status_code=503, detail="Suppression list not loaded yet, try again later")
+
+async def suppress(phone_nb: str, reason: str, shortcode_cd: Optional[str] = None) -> Suppression:
+    msisdn = normalize_msisdn(phone_nb)
+    if msisdn is None:
+        raise HTTPException(status_code=400, detail="Invalid phone number")
+    suppression = Suppression(phone_nb=f"+{msisdn}", reason=reason, shortcode_cd=shortcode_cd)
+    # Upsert keeps the first opt-out record when a number sends STOP twice
+    result = await Collections.suppression.find_one_and_update(
+        {"msisdn": msisdn},
+        {"$setOnInsert": {**suppression.model_dump(exclude={"id_mongo"}), "msisdn": msisdn}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    suppression_list.add(msisdn)
+    return Suppression(**to_response(result))
+
+async def unsuppress(phone_nb: str) -> bool:
+    msisdn = normalize_msisdn(phone_nb)
+    if msisdn is None:
+        raise HTTPException(status_code=400, detail="Invalid phone number")
+    result = await Collections.suppression.delete_one({"msisdn": msisdn})
+    suppression_list.remove(msisdn)
+    return bool(result.deleted_count)
+
+@app.post("/shortcodes/{cd}/inbound")
+async def receive_inbound_message(cd: str, message: InboundMessage):
+    if await cached_find_one(Collections.shortcode, "cd", cd) is None:
+        raise HTTPException(status_code=404, detail="Shortcode not found")
+    keyword = message.text.strip().split(maxsplit=1)[0].upper() if message.text.strip() else ""
+    if keyword in STOP_KEYWORDS:
+        await suppress(message.phone_nb, "stop", cd)
+        return {"action": "opted_out"}
+    if keyword in START_KEYWORDS:
+        await unsuppress(message.phone_nb)
+        return {"action": "opted_in"}
+    return {"action": "ignored"}
+
+@app.post("/suppressions/", response_model=Suppression)
+async def create_suppression(suppression: Suppression):
+    return await suppress(suppression.phone_nb, suppression.reason, suppression.shortcode_cd)
+
+@app.get("/suppressions/", response_model=Page)
+async def list_suppressions(
+    reason: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.suppression, Suppression, {"reason": reason}, cursor, limit, fields)
+
+@app.get("/suppressions/stats")
+async def read_suppression_stats():
+    return suppression_list.stats()
+
+@app.delete("/suppressions/{phone_nb}")
+async def delete_suppression(phone_nb: str):
+    if await unsuppress(phone_nb):
+        return {"message": "Suppression deleted"}
+    raise HTTPException(status_code=404, detail="Suppression not found")
+
 # Analytics Endpoints
 @app.post("/analytics/", response_model=Analytics)
 async def create_analytics(analytics: Analytics):
     analytics_dict = analytics.model_dump()
-    result = Collections.analytic.insert_one(analytics_dict)
+    result = await Collections.analytic.insert_one(analytics_dict)
     analytics.id_mongo = str(result.inserted_id)
     return analytics
 
-@app.get("/analytics/{campaign_id}", response_model=Analytics)
-async def read_analytics(campaign_id: str):
-    analytics = Collections.analytic.find_one({"campaign_id": campaign_id})
+def rollup_to_analytics(rollup: dict) -> dict:
+    metrics = rollup.get("metrics", {})
+    total = metrics.get("total", 0)
+    return {
+        "campaign_id": rollup["campaign_id"],
+        "delivery_rt": round(100.0 * metrics.get("delivered", 0) / total, 2) if total else 0.0,
+        "metrics": metrics,
+        "timestamp_dt": rollup["updated_dt"] if rollup["granularity"] == "total" else rollup["timestamp_dt"],
+        "id_mongo": str(rollup["_id"]),
+    }
+
+ROLLUP_GRANULARITIES = ("minute", "hour", "day")
+ROLLUP_DEFAULT_WINDOW = {"minute": timedelta(days=1), "hour": timedelta(days=30), "day": timedelta(days=365)}
+ROLLUP_EPOCH = datetime(1970, 1, 1)  # timestamp_dt of the all-time rollup
+
+def to_utc(ts: datetime) -> datetime:
+    # Mongo stores naive UTC, so aware datetimes are normalised before bucketing or querying
+    return ts.astimezone(timezone.utc).replace(tzinfo=None) if ts.tzinfo else ts
+
+def bucket_start(ts: datetime, granularity: str) -> datetime:
+    ts = to_utc(ts).replace(second=0, microsecond=0)
+    if granularity == "minute":
+        return ts
+    if granularity == "hour":
+        return ts.replace(minute=0)
+    return ts.replace(hour=0, minute=0)
+
+@app.get("/analytics/", response_model=Page)
+async def list_analytics(
+    campaign_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(
+        Collections.analytic,
+        Analytics,
+        {"campaign_id": campaign_id},
+        cursor,
+        limit,
+        fields,
+        sort_field="timestamp_dt",
+    )
+
+@app.get("/analytics/{campaign_id}", response_model=Union[AnalyticsSeries, Analytics])
+async def read_analytics(
+    campaign_id: str,
+    from_dt: Optional[datetime] = Query(None, alias="from"),
+    to_dt: Optional[datetime] = Query(None, alias="to"),
+    granularity: Optional[str] = Query(None, pattern="^(minute|hour|day)$"),
+    limit: int = Query(1440, ge=1, le=10000),  # a day of minute buckets, the default minute window
+):
+    if granularity or from_dt or to_dt:
+        # Range read over the pre-aggregated buckets, served by the unique
+        # (campaign_id, granularity, timestamp_dt) index without touching raw receipts
+        granularity = granularity or "hour"
+        to_dt = to_utc(to_dt) if to_dt else datetime.utcnow()
+        from_dt = to_utc(from_dt) if from_dt else to_dt - ROLLUP_DEFAULT_WINDOW[granularity]
+        if from_dt > to_dt:
+            raise HTTPException(status_code=400, detail="'from' must not be after 'to'")
+        # Newest first so a limit cuts the oldest buckets; one extra row tells whether it cut any
+        cursor = Collections.analytic_rollup.find(
+            {
+                "campaign_id": campaign_id,
+                "granularity": granularity,
+                "timestamp_dt": {"$gte": bucket_start(from_dt, granularity), "$lte": to_dt},
+            }
+        ).sort("timestamp_dt", -1).limit(limit + 1)
+        rollups = await cursor.to_list(None)
+        truncated = len(rollups) > limit
+        rollups = rollups[:limit][::-1]
+        return CODECS[AnalyticsSeries].response(
+            {
+                "campaign_id": campaign_id,
+                "granularity": granularity,
+                "from_dt": from_dt,
+                "to_dt": to_dt,
+                "buckets": [rollup_to_analytics(rollup) for rollup in rollups],
+                "truncated": truncated,
+                "next_to_dt": rollups[0]["timestamp_dt"] - timedelta(microseconds=1) if truncated else None,
+            }
+        )
+    # Precomputed DLR rollup first, hand-posted analytics for campaigns without receipts
+    rollup = await Collections.analytic_rollup.find_one({"campaign_id": campaign_id, "granularity": "total"})
+    if rollup:
+        return CODECS[Analytics].response(rollup_to_analytics(rollup))
+    analytics = await Collections.analytic.find_one({"campaign_id": campaign_id})
     if analytics:
-        analytics["id_mongo"] = str(analytics.pop("_id"))
-        return analytics
+        return CODECS[Analytics].response(to_response(analytics))
     raise HTTPException(status_code=404, detail="Analytics not found")
 
+# Delivery Report Endpoints
+DLR_FLUSH_SIZE = int(os.getenv("DLR_FLUSH_SIZE", "5000"))
+DLR_FLUSH_INTERVAL = float(os.getenv("DLR_FLUSH_INTERVAL", "1.0"))
+
+DLR_RECOVERY_INTERVAL = float(os.getenv("DLR_RECOVERY_INTERVAL", "60"))
+DLR_RECOVERY_GRACE = timedelta(minutes=10)  # unfinished batches older than this are taken over by any worker
+DLR_PENDING_ROLLUPS = 100  # batch ids a rollup remembers; only batches interrupted mid-flush stay listed
+
+def rollup_update(key: tuple, batch_id: ObjectId, counters: Optional[dict] = None, upsert: bool = True) -> UpdateOne:
+    campaign_id, granularity, timestamp_dt = key
+    query = {"campaign_id": campaign_id, "granularity": granularity, "timestamp_dt": timestamp_dt}
+    if counters is None:
+        return UpdateOne(query, {"$pull": {"pending_rollups": batch_id}})
+    # Applies only if this rollup has not listed the batch yet, so a retried batch never counts twice
+    return UpdateOne(
+        {**query, "pending_rollups": {"$ne": batch_id}},
+        {
+            "$inc": counters,
+            "$set": {"updated_dt": datetime.utcnow()},
+            "$push": {"pending_rollups": {"$each": [batch_id], "$slice": -DLR_PENDING_ROLLUPS}},
+        },
+        upsert=upsert,
+    )
+
+class DLRBuffer:
+    """Buffers receipts in memory and writes them plus their rollup increments in bulk.
+
+    Each flush is a batch. Its receipts are stored with the batch id and rolled_up false, the
+    $inc per rollup is applied only where the batch id is not listed yet, then the receipts are
+    marked rolled up and the id is pulled again. A batch interrupted at any step is finished by
+    the next flush, or by recover() in any worker, without counting a receipt twice.
+    """
+
+    def __init__(self):
+        self.reports = []
+        self.batches = {}  # batch id -> receipts not stored yet; empty once all are in Mongo
+        self.lock = asyncio.Lock()
+
+    def add(self, reports: list):
+        self.reports.extend(reports)
+
+    def pending(self) -> int:
+        return len(self.reports) + sum(map(len, self.batches.values()))
+
+    async def flush(self):
+        async with self.lock:
+            if self.reports:
+                batch_id = ObjectId()
+                self.batches[batch_id] = [
+                    {**report.model_dump(), "rollup_id": batch_id, "rolled_up": False} for report in self.reports
+                ]
+                self.reports = []
+            # Batches left by a failed flush go first, under the same id, so a retry is idempotent
+            for batch_id in list(self.batches):
+                await self.store(batch_id)
+                await self.roll_up(batch_id)
+                if not self.batches[batch_id]:
+                    del self.batches[batch_id]
+
+    async def store(self, batch_id: ObjectId):
+        docs = self.batches[batch_id]
+        if not docs:
+            return
+        failed = []
+        try:
+            await Collections.dlr.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Duplicates were stored before, by an earlier try of this batch or as another batch's receipt
+            failed = [docs[error["index"]] for error in e.details["writeErrors"] if error["code"] != 11000]
+            if failed:
+                logger.error("%d delivery reports failed to insert, retrying on the next flush", len(failed))
+        self.batches[batch_id] = failed
+
+    async def roll_up(self, batch_id: ObjectId):
+        # Pre-aggregate so thousands of receipts become one $inc per campaign and bucket
+        increments = {}
+        receipts = Collections.dlr.find(
+            {"rollup_id": batch_id, "rolled_up": False},
+            {"_id": 0, "campaign_id": 1, "status": 1, "timestamp_dt": 1},
+        )
+        async for receipt in receipts:
+            keys = [
+                (receipt["campaign_id"], nm, bucket_start(receipt["timestamp_dt"], nm)) for nm in ROLLUP_GRANULARITIES
+            ]
+            keys.append((receipt["campaign_id"], "total", ROLLUP_EPOCH))
+            for key in keys:
+                counters = increments.setdefault(key, {"metrics.total": 0})
+                counters["metrics.total"] += 1
+                counters[f"metrics.{receipt['status']}"] = counters.get(f"metrics.{receipt['status']}", 0) + 1
+        if not increments:
+            return
+        keys = list(increments)
+        try:
+            await Collections.analytic_rollup.bulk_write(
+                [rollup_update(key, batch_id, increments[key]) for key in keys], ordered=False
+            )
+        except BulkWriteError as e:
+            errors = e.details["writeErrors"]
+            if any(error["code"] != 11000 for error in errors):
+                raise
+            # The bucket exists but did not match: either it already lists the batch, or a racing
+            # upsert created it first. Without upsert the $inc lands only in the second case.
+            await Collections.analytic_rollup.bulk_write(
+                [rollup_update(keys[error["index"]], batch_id, increments[keys[error["index"]]], False) for error in errors],
+                ordered=False,
+            )
+        await Collections.dlr.update_many(
+            {"rollup_id": batch_id, "rolled_up": False}, {"$set": {"rolled_up": True}}
+        )
+        await Collections.analytic_rollup.bulk_write([rollup_update(key, batch_id) for key in keys], ordered=False)
+
+    async def recover(self):
+        """Rolls up batches whose worker stored the receipts but stopped before finishing."""
+        cutoff = ObjectId.from_datetime(datetime.utcnow() - DLR_RECOVERY_GRACE)
+        batch_ids = await Collections.dlr.distinct("rollup_id", {"rolled_up": False, "rollup_id": {"$lt": cutoff}})
+        async with self.lock:
+            for batch_id in batch_ids:
+                await self.roll_up(batch_id)
+
+    async def run(self):
+        recovered = time.monotonic()
+        while True:
+            await asyncio.sleep(DLR_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+                if time.monotonic() - recovered >= DLR_RECOVERY_INTERVAL:
+                    await self.recover()
+                    recovered = time.monotonic()
+            except PyMongoError as e:
+                logger.warning("Delivery report flush failed, %d receipts pending: %s", self.pending(), e)
+
+dlr_buffer = DLRBuffer()
+
+@app.post("/dlr/", status_code=202)
+async def receive_delivery_reports(reports: Union[DeliveryReport, List[DeliveryReport]]):
+    if isinstance(reports, DeliveryReport):
+        reports = [reports]
+    dlr_buffer.add(reports)
+    if len(dlr_buffer.reports) >= DLR_FLUSH_SIZE:
+        try:
+            await dlr_buffer.flush()
+        except PyMongoError as e:
+            # Accepted receipts stay buffered; the background flush retries them
+            logger.warning("Delivery report flush failed, %d receipts pending: %s", dlr_buffer.pending(), e)
+    return {"accepted": len(reports)}
+
 # OTP Endpoints
-@app.post("/otp/", response_model=OTPAuthentication)
-async def create_otp(otp: OTPAuthentication):
-    otp_dict = otp.model_dump()
-    result = Collections.otp.insert_one(otp_dict)
+# Required to serve: one key shared by every worker, so codes verify anywhere and survive restarts
+OTP_SECRET = os.getenv("OTP_SECRET", "").encode()
+OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", "5"))
+OTP_MAX_ISSUES = int(os.getenv("OTP_MAX_ISSUES", "3"))
+OTP_ATTEMPT_WINDOW = float(os.getenv("OTP_ATTEMPT_WINDOW", "900"))  # seconds
+OTP_DEFAULT_TTL = 300  # seconds, for POST /otp/ requests without an expiry
+OTP_MIN_TTL, OTP_MAX_TTL = 30, 3600
+OTP_SEND_TIMEOUT = float(os.getenv("OTP_SEND_TIMEOUT", "10"))  # seconds
+OTP_MESSAGE = os.getenv("OTP_MESSAGE", "Your verification code is {cd}")
+
+class AttemptCounter:
+    """Fixed-window attempt counts per key; windows are reaped oldest first."""
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self.windows = OrderedDict()
+
+    def allow(self, *keys: str) -> bool:
+        now = time.monotonic()
+        while self.windows:
+            key, (count, started) = next(iter(self.windows.items()))
+            if started + self.window > now:
+                break
+            del self.windows[key]
+        counts = [self.windows.setdefault(key, [0, now]) for key in keys]
+        if any(count[0] >= self.limit for count in counts):
+            return False
+        for count in counts:
+            count[0] += 1
+        return True
+
+    def reset(self, *keys: str):
+        for key in keys:
+            self.windows.pop(key, None)
+
+otp_attempts = AttemptCounter(OTP_MAX_ATTEMPTS, OTP_ATTEMPT_WINDOW)
+otp_issues = AttemptCounter(OTP_MAX_ISSUES, OTP_ATTEMPT_WINDOW)
+
+def generate_otp_code() -> str:
+    return f"{secrets.randbelow(1000000):06d}"
+
+def otp_hash(user_id: str, cd: str) -> str:
+    return hmac.new(OTP_SECRET, f"{user_id}:{cd}".encode(), hashlib.sha256).hexdigest()
+
+async def store_otp(otp: OTPAuthentication) -> OTPAuthentication:
+    # Only the latest code per user stays valid
+    await Collections.otp.delete_many({"user_id": otp.user_id})
+    otp_dict = otp.model_dump(exclude={"cd", "id_mongo"})
+    otp_dict["cd_hash"] = otp_hash(otp.user_id, otp.cd)
+    result = await Collections.otp.insert_one(otp_dict)
     otp.id_mongo = str(result.inserted_id)
     return otp
 
+# Gateways for OTP codes, created on first use; the dispatch worker keeps its own
+otp_balancer = None
+
+async def send_otp_sms(phone_nb: str, cd: str) -> bool:
+    global otp_balancer
+    if otp_balancer is None:
+        otp_balancer = GatewayBalancer(httpx.AsyncClient(timeout=DISPATCH_HTTP_TIMEOUT))
+    otp_balancer.refresh(await Collections.gateway.find({"status": "active"}).to_list(None))
+    if not otp_balancer.senders:
+        return False
+    try:
+        return await asyncio.wait_for(otp_balancer.send("otp", [phone_nb], OTP_MESSAGE.format(cd=cd)), OTP_SEND_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False
+
+async def issue_otp_code(user_id: str, phone_nb: Optional[str], ttl: int) -> OTPAuthentication:
+    """Stores a new code for the user and texts it to their registered number; the response
+    never carries the code, so only the holder of that phone can verify."""
+    user = await Collections.user.find_one({"id": user_id}, {"_id": 0, "phone_nb": 1})
+    # One answer for unknown users and wrong numbers, so the endpoint does not reveal which users exist
+    if user is None or (phone_nb is not None and phone_nb != user["phone_nb"]):
+        raise HTTPException(status_code=400, detail="phone_nb does not match the user's registered number")
+    now = datetime.utcnow()
+    otp = await store_otp(
+        OTPAuthentication(
+            user_id=user_id,
+            cd=generate_otp_code(),
+            phone_nb=user["phone_nb"],
+            expiry_dt=now + timedelta(seconds=ttl),
+            created_dt=now,
+        )
+    )
+    if not await send_otp_sms(otp.phone_nb, otp.cd):
+        await Collections.otp.delete_one({"_id": ObjectId(otp.id_mongo)})
+        raise HTTPException(status_code=503, detail="OTP could not be sent, try again later")
+    otp.cd = None
+    return otp
+
+@app.post("/otp/", response_model=OTPAuthentication)
+async def create_otp(otp: OTPAuthentication):
+    # Kept for existing clients: cd is ignored and expiry_dt only requests a TTL, capped as in /otp/issue
+    if not otp_issues.allow(f"user:{otp.user_id}"):
+        raise HTTPException(status_code=429, detail="Too many OTP requests")
+    ttl = OTP_DEFAULT_TTL
+    if otp.expiry_dt is not None:
+        ttl = int((to_utc(otp.expiry_dt) - datetime.utcnow()).total_seconds())
+    return await issue_otp_code(otp.user_id, otp.phone_nb, min(max(ttl, OTP_MIN_TTL), OTP_MAX_TTL))
+
+@app.post("/otp/issue", response_model=OTPAuthentication)
+async def issue_otp(request: OTPIssue):
+    if not otp_issues.allow(f"user:{request.user_id}", f"phone:{request.phone_nb}"):
+        raise HTTPException(status_code=429, detail="Too many OTP requests")
+    return await issue_otp_code(request.user_id, request.phone_nb, request.ttl)
+
+@app.post("/otp/verify")
+async def verify_otp(request: OTPVerify):
+    keys = [f"user:{request.user_id}"]
+    query = {"user_id": request.user_id, "expiry_dt": {"$gt": datetime.utcnow()}}
+    if request.phone_nb:
+        keys.append(f"phone:{request.phone_nb}")
+        query["phone_nb"] = request.phone_nb
+    if not otp_attempts.allow(*keys):
+        raise HTTPException(status_code=429, detail="Too many OTP attempts")
+    cd_hash = otp_hash(request.user_id, request.cd)
+    # Matching on the keyed hash consumes the code in the same round trip; lookup timing says nothing
+    # about the code itself, and the digest comparison guards whatever the query returned
+    query["cd_hash"] = cd_hash
+    otp = await Collections.otp.find_one_and_delete(query, {"cd_hash": 1}, sort=[("created_dt", -1)])
+    if otp is None or not hmac.compare_digest(otp["cd_hash"], cd_hash):
+        raise HTTPException(status_code=400, detail="Invalid or expired OTP")
+    otp_attempts.reset(*keys)
+    return {"message": "OTP verified"}
+
+@app.get("/otp/", response_model=Page)
+async def list_otps(
+    user_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(
+        Collections.otp,
+        OTPAuthentication,
+        {"user_id": user_id},
+        cursor,
+        limit,
+        fields,
+    )
+
 @app.get("/otp/{user_id}", response_model=OTPAuthentication)
 async def read_otp(user_id: str):
-    otp = Collections.otp.find_one({"user_id": user_id})
+    otp = await Collections.otp.find_one(
+        {"user_id": user_id, "expiry_dt": {"$gt": datetime.utcnow()}},
+        {"cd_hash": 0},
+        sort=[("created_dt", -1)],
+    )
     if otp:
-        otp["id_mongo"] = str(otp.pop("_id"))
-        return otp
+        return CODECS[OTPAuthentication].response(to_response(otp))
     raise HTTPException(status_code=404, detail="OTP not found")
 
 @app.delete("/otp/{user_id}")
 async def delete_otp(user_id: str):
-    result = Collections.otp.delete_one({"user_id": user_id})
+    result = await Collections.otp.delete_one({"user_id": user_id})
     if result.deleted_count:
         return {"message": "OTP deleted"}
     raise HTTPException(status_code=404, detail="OTP not found")
@@ -319,67 +2235,121 @@ async def delete_otp(user_id: str):
 @app.post("/sms-gateways/", response_model=SMSGateway)
 async def create_sms_gateway(gateway: SMSGateway):
     gateway_dict = gateway.model_dump()
-    if Collections.gateway.find_one({"id": gateway.id}):
+    try:
+        result = await Collections.gateway.insert_one(gateway_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Gateway ID already exists")
-    result = Collections.gateway.insert_one(gateway_dict)
     gateway.id_mongo = str(result.inserted_id)
     return gateway
 
+@app.get("/sms-gateways/", response_model=Page)
+async def list_sms_gateways(
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.gateway, SMSGateway, {"status": status}, cursor, limit, fields)
+
+@app.post("/sms-gateways/bulk", response_model=List[BulkItemResult])
+async def bulk_create_sms_gateways(items: List[SMSGateway]):
+    return await bulk_create(Collections.gateway, "id", items)
+
+@app.put("/sms-gateways/bulk", response_model=List[BulkItemResult])
+async def bulk_update_sms_gateways(items: List[SMSGateway]):
+    return await bulk_update(Collections.gateway, "id", items)
+
+@app.delete("/sms-gateways/bulk", response_model=List[BulkItemResult])
+async def bulk_delete_sms_gateways(keys: List[str] = Body(...)):
+    return await bulk_delete(Collections.gateway, "id", keys)
+
 @app.get("/sms-gateways/{id}", response_model=SMSGateway)
 async def read_sms_gateway(id: str):
-    gateway = Collections.gateway.find_one({"id": id})
+    gateway = await cached_find_one(Collections.gateway, "id", id)
     if gateway:
-        gateway["id_mongo"] = str(gateway.pop("_id"))
-        return gateway
+        return CODECS[SMSGateway].response(gateway)
     raise HTTPException(status_code=404, detail="SMS Gateway not found")
 
 @app.put("/sms-gateways/{id}", response_model=SMSGateway)
 async def update_sms_gateway(id: str, gateway: SMSGateway):
     gateway_dict = gateway.model_dump(exclude={"id_mongo"})
-    result = Collections.gateway.update_one({"id": id}, {"$set": gateway_dict})
-    if result.matched_count:
-        gateway.id_mongo = str(Collections.gateway.find_one({"id": id})["_id"])
+    result = await Collections.gateway.find_one_and_update(
+        {"id": id}, {"$set": gateway_dict}, projection={"_id": 1}
+    )
+    Caches.gateway.invalidate(id, gateway.id)
+    if result:
+        gateway.id_mongo = str(result["_id"])
         return gateway
     raise HTTPException(status_code=404, detail="SMS Gateway not found")
 
 @app.delete("/sms-gateways/{id}")
 async def delete_sms_gateway(id: str):
-    result = Collections.gateway.delete_one({"id": id})
+    result = await Collections.gateway.delete_one({"id": id})
+    Caches.gateway.invalidate(id)
     if result.deleted_count:
         return {"message": "SMS Gateway deleted"}
     raise HTTPException(status_code=404, detail="SMS Gateway not found")
 
+@app.get("/gateway-stats/", response_model=List[GatewayStat])
+async def read_gateway_stats(gateway_id: Optional[str] = None, max_age: int = 60):
+    # Live stats as last published by each dispatch worker
+    query = {"updated_dt": {"$gte": datetime.utcnow() - timedelta(seconds=max_age)}}
+    if gateway_id:
+        query["gateway_id"] = gateway_id
+    return await Collections.gateway_stat.find(query, {"_id": 0}).to_list(None)
+
 # User Endpoints
 @app.post("/users/", response_model=User)
 async def create_user(user: User):
     user_dict = user.model_dump()
-    if Collections.user.find_one({"id": user.id}) or \
-       Collections.user.find_one({"email": user.email}):
+    try:
+        result = await Collections.user.insert_one(user_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="User ID or email already exists")
-    result = Collections.user.insert_one(user_dict)
     user.id_mongo = str(result.inserted_id)
     return user
 
+@app.get("/users/", response_model=Page)
+async def list_users(
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.user, User, {}, cursor, limit, fields)
+
+@app.post("/users/bulk", response_model=List[BulkItemResult])
+async def bulk_create_users(items: List[User]):
+    return await bulk_create(Collections.user, "id", items)
+
+@app.put("/users/bulk", response_model=List[BulkItemResult])
+async def bulk_update_users(items: List[User]):
+    return await bulk_update(Collections.user, "id", items)
+
+@app.delete("/users/bulk", response_model=List[BulkItemResult])
+async def bulk_delete_users(keys: List[str] = Body(...)):
+    return await bulk_delete(Collections.user, "id", keys)
+
 @app.get("/users/{id}", response_model=User)
 async def read_user(id: str):
-    user = Collections.user.find_one({"id": id})
+    user = await Collections.user.find_one({"id": id})
     if user:
-        user["id_mongo"] = str(user.pop("_id"))
-        return user
+        return CODECS[User].response(to_response(user))
     raise HTTPException(status_code=404, detail="User not found")
 
 @app.put("/users/{id}", response_model=User)
 async def update_user(id: str, user: User):
     user_dict = user.model_dump(exclude={"id_mongo"})
-    result = Collections.user.update_one({"id": id}, {"$set": user_dict})
-    if result.matched_count:
-        user.id_mongo = str(Collections.user.find_one({"id": id})["_id"])
+    result = await Collections.user.find_one_and_update(
+        {"id": id}, {"$set": user_dict}, projection={"_id": 1}
+    )
+    if result:
+        user.id_mongo = str(result["_id"])
         return user
     raise HTTPException(status_code=404, detail="User not found")
 
 @app.delete("/users/{id}")
 async def delete_user(id: str):
-    result = Collections.user.delete_one({"id": id})
+    result = await Collections.user.delete_one({"id": id})
     if result.deleted_count:
         return {"message": "User deleted"}
     raise HTTPException(status_code=404, detail="User not found")
@@ -388,82 +2358,1038 @@ async def delete_user(id: str):
 @app.post("/scheduler/", response_model=Scheduler)
 async def create_scheduler(scheduler: Scheduler):
     scheduler_dict = scheduler.model_dump()
-    if Collections.scheduler.find_one({"id": scheduler.id}):
+    try:
+        result = await Collections.scheduler.insert_one(scheduler_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Scheduler ID already exists")
-    result = Collections.scheduler.insert_one(scheduler_dict)
     scheduler.id_mongo = str(result.inserted_id)
     return scheduler
 
+@app.get("/scheduler/", response_model=Page)
+async def list_schedulers(
+    status: Optional[str] = None,
+    campaign_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(
+        Collections.scheduler,
+        Scheduler,
+        {"status": status, "campaign_id": campaign_id},
+        cursor,
+        limit,
+        fields,
+    )
+
 # Service Endpoints
 @app.post("/service/", response_model=Service)
 async def create_service(service: Service):
     service_dict = service.model_dump()
-    if Collections.service.find_one({"id": service.id}):
+    try:
+        result = await Collections.service.insert_one(service_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Service ID already exists")
-    result = Collections.service.insert_one(service_dict)
     service.id_mongo = str(result.inserted_id)
     return service
 
+@app.get("/service/", response_model=Page)
+async def list_services(
+    status: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.service, Service, {"status": status}, cursor, limit, fields)
+
+@app.get("/service/{id}", response_model=Service)
+async def read_service(id: str):
+    service = await cached_find_one(Collections.service, "id", id)
+    if service:
+        return CODECS[Service].response(service)
+    raise HTTPException(status_code=404, detail="Service not found")
+
 # Ticket Endpoints
 @app.post("/ticket/", response_model=Ticket)
 async def create_ticket(ticket: Ticket):
     ticket_dict = ticket.model_dump()
-    if Collections.ticket.find_one({"id": ticket.id}):
+    try:
+        result = await Collections.ticket.insert_one(ticket_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Ticket ID already exists")
-    result = Collections.ticket.insert_one(ticket_dict)
     ticket.id_mongo = str(result.inserted_id)
     return ticket
 
+@app.get("/ticket/", response_model=Page)
+async def list_tickets(
+    status: Optional[str] = None,
+    user_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(
+        Collections.ticket,
+        Ticket,
+        {"status": status, "user_id": user_id},
+        cursor,
+        limit,
+        fields,
+    )
+
+# Credit Ledger
+# Balances are integers in minor units of one billing currency, so concurrent $inc never drifts
+BILLING_CURRENCY = os.getenv("BILLING_CURRENCY", "KES")
+SMS_SEGMENT_PRICE = int(os.getenv("SMS_SEGMENT_PRICE", "80"))  # minor units per SMS segment
+RECONCILE_BATCH_SIZE = 1000
+
+def to_minor_units(amount: float) -> int:
+    return int(round(amount * 100))
+
+async def adjust_credit(user_id: str, amount: int, require_funds: bool = False) -> bool:
+    # The balance guard and the $inc are one single-document update, so parallel debits cannot overdraw
+    query = {"user_id": user_id}
+    if require_funds:
+        query["balance"] = {"$gte": -amount}
+    result = await Collections.credit_account.update_one(
+        query,
+        {
+            "$inc": {"balance": amount},
+            "$set": {"updated_dt": datetime.utcnow()},
+            "$setOnInsert": {"reserved": 0, "currency": BILLING_CURRENCY},
+        },
+        upsert=not require_funds,
+    )
+    return bool(result.modified_count or result.upserted_id)
+
+async def record_ledger_entry(entry: CreditLedgerEntry) -> bool:
+    try:
+        await Collections.credit_ledger.insert_one(entry.model_dump(exclude={"id_mongo"}))
+    except DuplicateKeyError:
+        return False
+    return True
+
+class CreditReservation:
+    """Billing for one claim of a dispatch job. Every batch holds its cost with one conditional
+    $inc and is charged in the ledger before it is sent; a failed batch gets a refund entry.
+    The account's reserved total is settled with a single write when the job ends.
+
+    The ledger is the source of truth: a charge entry exists for every batch that may have gone
+    out, so reserved left behind by a crashed job is treated as charged by reconcile_credits.
+
+    Batches take their turn to reserve in seq order, so once one is unfunded every later batch
+    is too and the job's checkpoint can stop right before it.
+    """
+
+    def __init__(self, user_id: str, campaign_id: str, ref_id: str):
+        self.user_id = user_id
+        self.campaign_id = campaign_id
+        self.ref_id = ref_id
+        self.charged = self.released = self.unfunded = 0
+        self.exhausted = False
+        self.turn = 0
+        self.turns = asyncio.Condition()
+
+    async def take_turn(self, seq: int):
+        async with self.turns:
+            await self.turns.wait_for(lambda: self.turn == seq)
+
+    async def end_turn(self):
+        async with self.turns:
+            self.turn += 1
+            self.turns.notify_all()
+
+    async def skip(self, seq: int):
+        # For a batch that fails before reserving, so later batches are not left waiting
+        await self.take_turn(seq)
+        await self.end_turn()
+
+    def entry(self, seq: int, amount: int, segments: int, suffix: str = "") -> CreditLedgerEntry:
+        return CreditLedgerEntry(
+            user_id=self.user_id,
+            kind="sms",
+            ref_id=f"{self.ref_id}:{seq}{suffix}",
+            amount=amount,
+            campaign_id=self.campaign_id,
+            segments=segments,
+        )
+
+    async def reserve(self, cost: int, segments: int, seq: int) -> bool:
+        await self.take_turn(seq)
+        try:
+            return await self.hold(cost, segments, seq)
+        finally:
+            await self.end_turn()
+
+    async def hold(self, cost: int, segments: int, seq: int) -> bool:
+        if self.exhausted:
+            return False
+        result = await Collections.credit_account.update_one(
+            {"user_id": self.user_id, "balance": {"$gte": cost}},
+            {"$inc": {"balance": -cost, "reserved": cost}},
+        )
+        if not result.modified_count:
+            self.exhausted = True
+            return False
+        # Hold first, ledger second: a crash in between leaves the balance short of the ledger
+        # total and reconcile_credits gives the hold back; nothing is sent without a charge entry
+        try:
+            recorded = await record_ledger_entry(self.entry(seq, -cost, segments))
+        except PyMongoError:
+            await self.release(cost)
+            raise
+        if not recorded:
+            await self.release(cost)
+            raise RuntimeError(f"Ledger entry {self.ref_id}:{seq} already exists")
+        return True
+
+    async def release(self, cost: int):
+        try:
+            await Collections.credit_account.update_one(
+                {"user_id": self.user_id},
+                {"$inc": {"balance": cost, "reserved": -cost}, "$set": {"updated_dt": datetime.utcnow()}},
+            )
+        except PyMongoError:
+            logger.exception("Could not release a %d hold for %s, left for reconcile_credits", cost, self.user_id)
+
+    async def settle(self, seq: int, cost: int, segments: int, ok: bool):
+        if ok:
+            self.charged += cost
+            return
+        try:
+            await record_ledger_entry(self.entry(seq, cost, segments, ":refund"))
+        except PyMongoError:
+            # Without a refund entry the batch stays charged, so the account must agree
+            logger.exception("Could not refund failed batch %s:%d, keeping it charged", self.ref_id, seq)
+            self.charged += cost
+            return
+        self.released += cost
+
+    async def close(self):
+        if self.charged or self.released:
+            try:
+                await Collections.credit_account.update_one(
+                    {"user_id": self.user_id},
+                    {
+                        "$inc": {"reserved": -(self.charged + self.released), "balance": self.released},
+                        "$set": {"updated_dt": datetime.utcnow()},
+                    },
+                )
+            except PyMongoError:
+                # The ledger already holds every charge and refund, so reconciliation settles it
+                logger.exception("Could not settle reservations for %s, left for reconcile_credits", self.ref_id)
+                return
+        self.charged = self.released = 0
+
+async def backfill_ledger(collection: Collection, kind: str, sign: int) -> int:
+    """Upserts a ledger entry for every completed payment or order that lacks one."""
+    added, requests = 0, []
+    query = {"status": "completed"}
+    if kind == "payment":
+        query["currency"] = BILLING_CURRENCY
+    async for doc in collection.find(query, {"_id": 0, "id": 1, "user_id": 1, "amount": 1, "created_dt": 1}):
+        entry = CreditLedgerEntry(
+            user_id=doc["user_id"], kind=kind, ref_id=doc["id"], amount=sign * to_minor_units(doc["amount"]),
+            created_dt=doc.get("created_dt") or datetime.utcnow(),
+        )
+        requests.append(
+            UpdateOne(
+                {"kind": kind, "ref_id": doc["id"]},
+                {"$setOnInsert": entry.model_dump(exclude={"id_mongo"})},
+                upsert=True,
+            )
+        )
+        if len(requests) == RECONCILE_BATCH_SIZE:
+            added += (await Collections.credit_ledger.bulk_write(requests, ordered=False)).upserted_count
+            requests = []
+    if requests:
+        added += (await Collections.credit_ledger.bulk_write(requests, ordered=False)).upserted_count
+    return added
+
+async def reconcile_credits() -> dict:
+    """Rolls completed Payment/Order history into the ledger, then resets each idle account's
+    balance to its ledger total. Reserved credit left on an idle account belongs to batches whose
+    charge is already in the ledger, so it is dropped as spent, not returned to the balance.
+    Accounts with a dispatch job holding a live lease are only reported."""
+    report = {
+        "payments_backfilled": await backfill_ledger(Collections.payment, "payment", 1),
+        "orders_backfilled": await backfill_ledger(Collections.order, "order", -1),
+        "accounts": 0,
+        "corrected": 0,
+        "skipped_busy": 0,
+        "drift": 0,
+        "unsettled": 0,
+    }
+    rows = await Collections.credit_ledger.aggregate([{"$group": {"_id": "$user_id", "total": {"$sum": "$amount"}}}])
+    totals = {row["_id"]: row["total"] async for row in rows}
+    # A running job whose lease has expired is dead and will be reclaimed from its checkpoint
+    fresh = datetime.utcnow() - timedelta(seconds=DISPATCH_LEASE_SECONDS)
+    running = await Collections.scheduler.distinct("campaign_id", {"status": "running", "claimed_dt": {"$gte": fresh}})
+    busy = set(await Collections.campaign.distinct("user_id", {"id": {"$in": running}})) if running else set()
+    accounts = {doc["user_id"]: doc async for doc in Collections.credit_account.find({}, {"_id": 0})}
+    for user_id in set(totals) | set(accounts):
+        report["accounts"] += 1
+        expected = totals.get(user_id, 0)
+        account = accounts.get(user_id)
+        if account is None:
+            await adjust_credit(user_id, expected)
+            report["corrected"] += 1
+            report["drift"] += abs(expected)
+            continue
+        drift = expected - account["balance"]
+        unsettled = account.get("reserved", 0)
+        if not drift and not unsettled:
+            continue
+        if user_id in busy:
+            report["skipped_busy"] += 1
+            continue
+        # Optimistic write: a reservation landing after the read leaves the account untouched until the next run
+        now = datetime.utcnow()
+        result = await Collections.credit_account.update_one(
+            {"user_id": user_id, "balance": account["balance"], "reserved": unsettled},
+            {"$set": {"balance": expected, "reserved": 0, "updated_dt": now, "reconciled_dt": now}},
+        )
+        if result.modified_count:
+            report["corrected"] += 1
+            report["drift"] += abs(drift)
+            report["unsettled"] += unsettled
+    return report
+
+@app.get("/credits/{user_id}", response_model=CreditAccount)
+async def read_credit_account(user_id: str):
+    account = await Collections.credit_account.find_one({"user_id": user_id}, {"_id": 0})
+    if account:
+        return CODECS[CreditAccount].response(account)
+    raise HTTPException(status_code=404, detail="Credit account not found")
+
+@app.get("/credits/{user_id}/ledger", response_model=Page)
+async def list_credit_ledger(
+    user_id: str,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(
+        Collections.credit_ledger,
+        CreditLedgerEntry,
+        {"user_id": user_id},
+        cursor,
+        limit,
+        fields,
+    )
+
+@app.post("/credits/reconcile")
+async def run_credit_reconciliation():
+    return await reconcile_credits()
+
 # Payment Endpoints
 @app.post("/payment/", response_model=Payment)
 async def create_payment(payment: Payment):
     payment_dict = payment.model_dump()
-    if Collections.payment.find_one({"id": payment.id}):
+    try:
+        result = await Collections.payment.insert_one(payment_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Payment ID already exists")
-    result = Collections.payment.insert_one(payment_dict)
+    if payment.status == "completed" and payment.currency == BILLING_CURRENCY:
+        # Balance before ledger: a crash in between is under-credit, which reconciliation restores
+        amount = to_minor_units(payment.amount)
+        await adjust_credit(payment.user_id, amount)
+        await record_ledger_entry(
+            CreditLedgerEntry(user_id=payment.user_id, kind="payment", ref_id=payment.id, amount=amount)
+        )
     payment.id_mongo = str(result.inserted_id)
     return payment
 
+@app.get("/payment/", response_model=Page)
+async def list_payments(
+    status: Optional[str] = None,
+    user_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(
+        Collections.payment,
+        Payment,
+        {"status": status, "user_id": user_id},
+        cursor,
+        limit,
+        fields,
+    )
+
 # Profile Endpoints
 @app.post("/profile/", response_model=Profile)
 async def create_profile(profile: Profile):
     profile_dict = profile.model_dump()
-    if Collections.profile.find_one({"id": profile.id}):
+    try:
+        result = await Collections.profile.insert_one(profile_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Profile ID already exists")
-    result = Collections.profile.insert_one(profile_dict)
     profile.id_mongo = str(result.inserted_id)
     return profile
 
+@app.get("/profile/", response_model=Page)
+async def list_profiles(
+    user_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.profile, Profile, {"user_id": user_id}, cursor, limit, fields)
+
 # Permission Endpoints
 @app.post("/permission/", response_model=Permission)
 async def create_permission(permission: Permission):
     permission_dict = permission.model_dump()
-    if Collections.permission.find_one({"id": permission.id}):
+    try:
+        result = await Collections.permission.insert_one(permission_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Permission ID already exists")
-    result = Collections.permission.insert_one(permission_dict)
     permission.id_mongo = str(result.inserted_id)
     return permission
 
+@app.get("/permission/", response_model=Page)
+async def list_permissions(
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(Collections.permission, Permission, {}, cursor, limit, fields)
+
 # Order Endpoints
 @app.post("/order/", response_model=Order)
 async def create_order(order: Order):
     order_dict = order.model_dump()
-    if Collections.order.find_one({"id": order.id}):
+    amount = to_minor_units(order.amount)
+    if order.status == "completed" and not await adjust_credit(order.user_id, -amount, require_funds=True):
+        raise HTTPException(status_code=400, detail="Insufficient credit")
+    try:
+        result = await Collections.order.insert_one(order_dict)
+    except DuplicateKeyError:
+        if order.status == "completed":
+            await adjust_credit(order.user_id, amount)
         raise HTTPException(status_code=400, detail="Order ID already exists")
-    result = Collections.order.insert_one(order_dict)
+    if order.status == "completed":
+        await record_ledger_entry(
+            CreditLedgerEntry(user_id=order.user_id, kind="order", ref_id=order.id, amount=-amount)
+        )
     order.id_mongo = str(result.inserted_id)
     return order
 
+@app.get("/order/", response_model=Page)
+async def list_orders(
+    status: Optional[str] = None,
+    user_id: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(
+        Collections.order,
+        Order,
+        {"status": status, "user_id": user_id},
+        cursor,
+        limit,
+        fields,
+    )
+
 # Support Endpoints (New)
 @app.post("/support/", response_model=Support)
 async def create_support(support: Support):
     support_dict = support.model_dump()
-    if Collections.support.find_one({"id": support.id}):
+    try:
+        result = await Collections.support.insert_one(support_dict)
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Support ID already exists")
-    result = Collections.support.insert_one(support_dict)
     support.id_mongo = str(result.inserted_id)
     return support
 
+@app.get("/support/", response_model=Page)
+async def list_supports(
+    status: Optional[str] = None,
+    user_id: Optional[str] = None,
+    category: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT),
+    fields: Optional[str] = None,
+):
+    return await list_documents(
+        Collections.support,
+        Support,
+        {"status": status, "user_id": user_id, "category": category},
+        cursor,
+        limit,
+        fields,
+    )
+
+# Dispatch Engine
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", "100"))
+DISPATCH_POLL_INTERVAL = float(os.getenv("DISPATCH_POLL_INTERVAL", "1.0"))
+DISPATCH_LEASE_SECONDS = int(os.getenv("DISPATCH_LEASE_SECONDS", "300"))
+# Each heartbeat renews the lease and saves the resume point, bounding what a reclaimed job re-sends
+DISPATCH_HEARTBEAT_SECONDS = float(os.getenv("DISPATCH_HEARTBEAT_SECONDS", "5.0"))
+DISPATCH_HTTP_TIMEOUT = float(os.getenv("DISPATCH_HTTP_TIMEOUT", "10.0"))
+DISPATCH_GATEWAY_CONCURRENCY = int(os.getenv("DISPATCH_GATEWAY_CONCURRENCY", "16"))
+DISPATCH_SEND_ATTEMPTS = int(os.getenv("DISPATCH_SEND_ATTEMPTS", "2"))
+DISPATCH_STATS_INTERVAL = float(os.getenv("DISPATCH_STATS_INTERVAL", "5.0"))
+
+# Circuit breaker thresholds, applied to per-gateway moving averages
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_LATENCY = float(os.getenv("BREAKER_LATENCY", "2.0"))  # seconds
+BREAKER_MIN_SAMPLES = int(os.getenv("BREAKER_MIN_SAMPLES", "10"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "1.0"))  # doubles per consecutive trip
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "60.0"))
+EWMA_ALPHA = 0.2
+
+class TokenBucket:
+    """Messages/second limiter; a rate of None means unlimited."""
+
+    def __init__(self, rate: Optional[float], capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate or 0.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate: Optional[float]):
+        # Keeps the tokens already earned, so changing the share does not grant a fresh burst
+        self.rate = rate
+        self.capacity = rate or 0.0
+        self.tokens = min(self.tokens, self.capacity)
+
+    async def acquire(self, n: int):
+        if not self.rate:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # A batch larger than the bucket may drive it negative, so one send never blocks forever
+            if self.tokens >= min(n, self.capacity):
+                self.tokens -= n
+                return
+            await asyncio.sleep((min(n, self.capacity) - self.tokens) / self.rate)
+
+class GatewaySender:
+    """One SMS gateway: token bucket, in-flight cap, latency/error averages and circuit breaker.
+
+    The gateway's tps is a limit across all workers, so the bucket runs at tps / (peers + 1),
+    where peers is the number of other workers currently sending through the gateway.
+    """
+
+    def __init__(self, gateway: dict, http: httpx.AsyncClient):
+        self.http = http
+        self.slots = asyncio.Semaphore(DISPATCH_GATEWAY_CONCURRENCY)
+        self.outstanding = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.samples = 0
+        self.open_until = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        self.probing = False
+        self.sent = self.failed = 0
+        self.window_sent, self.window_start = 0, time.monotonic()
+        self.peers = 0
+        self.bucket = TokenBucket(None)
+        self.update(gateway)
+
+    def update(self, gateway: dict):
+        self.gateway = gateway
+        self.weight = gateway.get("weight") or 1.0
+        self.share(self.peers)
+
+    def share(self, peers: int):
+        self.peers = peers
+        tps = self.gateway.get("tps")
+        rate = tps / (peers + 1) if tps else None
+        if rate != self.bucket.rate:
+            if self.bucket.rate is None:
+                self.bucket = TokenBucket(rate)
+            else:
+                self.bucket.set_rate(rate)
+
+    @property
+    def state(self) -> str:
+        if not self.open_until:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half_open"
+
+    def available(self) -> bool:
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self.probing)
+
+    def score(self) -> float:
+        # Weighted least outstanding requests, scaled by latency so slow gateways drain less
+        return (self.outstanding + 1) * max(self.latency, 0.001) / self.weight
+
+    def record(self, ok: bool, latency: float, n: int):
+        self.samples += 1
+        self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.sent += n
+            self.window_sent += n
+        else:
+            self.failed += n
+        if self.probing:
+            self.probing = False
+            if ok:
+                self.open_until, self.cooldown = 0.0, BREAKER_COOLDOWN
+                self.error_rate, self.samples = 0.0, 0
+            else:
+                self.trip()
+        elif self.samples >= BREAKER_MIN_SAMPLES and (
+            self.error_rate > BREAKER_ERROR_RATE or self.latency > BREAKER_LATENCY
+        ):
+            self.trip()
+
+    def trip(self):
+        self.open_until = time.monotonic() + self.cooldown
+        self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+
+    async def send(self, campaign_id: str, recipients: list, message: Union[str, List[str]]) -> bool:
+        # A list message is personalised, one text per recipient in the same order
+        if self.state == "half_open":
+            self.probing = True
+        self.outstanding += 1
+        try:
+            await self.bucket.acquire(len(recipients))
+            async with self.slots:
+                started = time.monotonic()
+                try:
+                    response = await self.http.post(
+                        self.gateway["api_endpoint"],
+                        json={"campaign_id": campaign_id, "to": recipients, "message": message},
+                        headers={"Authorization": f"Bearer {self.gateway['api_key']}"},
+                    )
+                    ok = response.is_success
+                except httpx.HTTPError:
+                    ok = False
+                self.record(ok, time.monotonic() - started, len(recipients))
+                return ok
+        finally:
+            self.outstanding -= 1
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        tps = self.window_sent / max(now - self.window_start, 1e-9)
+        self.window_sent, self.window_start = 0, now
+        return {
+            "gateway_id": self.gateway["id"],
+            "state": self.state,
+            "tps": round(tps, 1),
+            "tps_limit": self.bucket.rate,
+            "latency_ms": round(self.latency * 1000, 2),
+            "error_rate": round(self.error_rate, 4),
+            "outstanding": self.outstanding,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
+
+class GatewayBalancer:
+    """Spreads batches over active gateways, skipping ones whose circuit is open."""
+
+    def __init__(self, http: httpx.AsyncClient):
+        self.http = http
+        self.senders = {}
+
+    def refresh(self, gateways: list):
+        active = set()
+        for gateway in gateways:
+            active.add(gateway["id"])
+            if gateway["id"] in self.senders:
+                self.senders[gateway["id"]].update(gateway)
+            else:
+                self.senders[gateway["id"]] = GatewaySender(gateway, self.http)
+        for gateway_id in set(self.senders) - active:
+            del self.senders[gateway_id]
+
+    def share(self, peers: Counter):
+        for gateway_id, sender in self.senders.items():
+            sender.share(peers[gateway_id])
+
+    def pick(self, exclude: set) -> Optional[GatewaySender]:
+        candidates = [s for s in self.senders.values() if s.available() and s.gateway["id"] not in exclude]
+        return min(candidates, key=GatewaySender.score, default=None)
+
+    async def send(self, campaign_id: str, recipients: list, message: Union[str, List[str]]) -> bool:
+        tried = set()
+        for _ in range(DISPATCH_SEND_ATTEMPTS):
+            sender = self.pick(tried)
+            while sender is None and not tried:
+                # Every circuit is open: wait for the earliest one to allow a probe
+                await asyncio.sleep(max(0.01, min(s.open_until for s in self.senders.values()) - time.monotonic()))
+                sender = self.pick(tried)
+            if sender is None:
+                return False
+            tried.add(sender.gateway["id"])
+            if await sender.send(campaign_id, recipients, message):
+                return True
+        return False
+
+    def snapshot(self) -> list:
+        return [sender.snapshot() for sender in self.senders.values()]
+
+class DispatchCheckpoint:
+    """Where a scheduler job resumes: the audience position after the last batch for which every
+    earlier batch has finished too, with the sent/failed totals and drop counts at that point."""
+
+    def __init__(self, resume: Optional[dict] = None):
+        resume = resume or {}
+        self.position = resume.get("position", {})
+        self.sent = resume.get("sent", 0)
+        self.failed = resume.get("failed", 0)
+        self.counts = resume.get("counts", {})
+        self.marks = deque()
+        self.finished = {}
+        self.next_seq = 0
+
+    def mark(self, position: dict, counts: dict):
+        self.marks.append((position, dict(counts)))
+
+    def finish(self, seq: int, sent: int, failed: int):
+        # Batches finish out of order; the resume point only moves over a contiguous prefix
+        self.finished[seq] = (sent, failed)
+        while self.next_seq in self.finished:
+            sent, failed = self.finished.pop(self.next_seq)
+            self.sent += sent
+            self.failed += failed
+            self.position, self.counts = self.marks.popleft()
+            self.next_seq += 1
+
+    def state(self) -> dict:
+        return {"position": self.position, "sent": self.sent, "failed": self.failed, "counts": self.counts}
+
+async def iter_campaign_batches(
+    campaign: dict,
+    size: int = DISPATCH_BATCH_SIZE,
+    counts: Optional[dict] = None,
+    checkpoint: Optional[DispatchCheckpoint] = None,
+):
+    """Inline audience then uploaded recipients, deduplicated across both and with suppressed
+    numbers removed; what was dropped is tallied in counts.
+
+    The inline audience is deduplicated into a sorted uint64 array. Uploaded recipients are
+    unique per campaign by index, so they only need checking against that array and no set of
+    every number sent grows with the campaign. They are read in phone_nb order, so with a
+    checkpoint each batch is marked with where it ends and a resumed job starts after the last
+    finished one.
+    """
+    if not await suppression_list.ready():
+        # Sending without the opt-outs is never an option, so the job fails and can be resumed
+        raise RuntimeError("Suppression list could not be loaded")
+    counts = counts if counts is not None else {}
+    for key in ("invalid", "duplicates", "suppressed"):
+        counts.setdefault(key, 0)
+    position = {}
+    if checkpoint is not None and checkpoint.position:
+        # The audience tallies were complete before the first batch, so the checkpoint's are kept
+        counts.update(checkpoint.counts)
+        position = checkpoint.position
+        audience = unique_numbers(campaign.get("target_audience", []), {"invalid": 0, "duplicates": 0})
+    else:
+        audience = unique_numbers(campaign.get("target_audience", []), counts)
+    batch = []
+    for index in range(position.get("audience", 0), len(audience)):
+        if audience[index] in suppression_list:
+            counts["suppressed"] += 1
+        else:
+            batch.append(f"+{audience[index]}")
+        if len(batch) == size:
+            if checkpoint is not None:
+                checkpoint.mark({"audience": index + 1}, counts)
+            yield batch
+            batch = []
+    query = {"campaign_id": campaign["id"]}
+    last = position.get("phone_nb")
+    if last:
+        query["phone_nb"] = {"$gt": last}
+    recipients = Collections.recipient.find(query, {"_id": 0, "phone_nb": 1}).sort("phone_nb", 1)
+    async for doc in recipients.batch_size(size * 10):
+        last = doc["phone_nb"]
+        msisdn = normalize_msisdn(last)
+        if msisdn is None:
+            counts["invalid"] += 1
+        elif contains(audience, msisdn):
+            counts["duplicates"] += 1
+        elif msisdn in suppression_list:
+            counts["suppressed"] += 1
+        else:
+            batch.append(f"+{msisdn}")
+        if len(batch) == size:
+            if checkpoint is not None:
+                checkpoint.mark({"audience": len(audience), "phone_nb": last}, counts)
+            yield batch
+            batch = []
+    if batch:
+        if checkpoint is not None:
+            checkpoint.mark({"audience": len(audience), "phone_nb": last}, counts)
+        yield batch
+
+async def dispatch_batches(
+    balancer: GatewayBalancer,
+    campaign_id: str,
+    batches,
+    message: Union[str, MessageTemplate],
+    billing: Optional[CreditReservation] = None,
+    checkpoint: Optional[DispatchCheckpoint] = None,
+):
+    """Send batches through the balancer. In-flight batches are bounded so huge audiences
+    stream through in constant memory. A template is rendered per batch inside its send task,
+    and with billing each batch reserves its segment cost before it is sent. An unfunded batch
+    is never finished in the checkpoint, so the resume point stays before it.
+
+    If a batch raises, batches already handed to a gateway are waited for and recorded before
+    the error propagates, so the checkpoint never points before a batch that went out.
+    """
+    sent = failed = 0
+    if isinstance(message, str):
+        message = compile_template(message, literal=True)
+    static_segments = None if message.fields else message.render_batch([None])[0][2]
+
+    async def send(seq: int, batch: list) -> tuple:
+        if static_segments is not None:
+            text, segments = message.format(), static_segments * len(batch)
+        else:
+            try:
+                rendered = await render_recipients(message, batch)
+            except Exception:
+                if billing is not None:
+                    await billing.skip(seq)
+                raise
+            text, segments = [item[0] for item in rendered], sum(item[2] for item in rendered)
+        cost = segments * SMS_SEGMENT_PRICE
+        if billing is not None and not await billing.reserve(cost, segments, seq):
+            billing.unfunded += len(batch)
+            return seq, None, None
+        ok = await balancer.send(campaign_id, batch, text)
+        if billing is not None:
+            await billing.settle(seq, cost, segments, ok)
+        return (seq, len(batch), 0) if ok else (seq, 0, len(batch))
+
+    def collect(done: set) -> Optional[BaseException]:
+        nonlocal sent, failed
+        error = None
+        for task in done:
+            if task.exception() is not None:
+                error = error or task.exception()
+                continue
+            seq, batch_sent, batch_failed = task.result()
+            if batch_sent is None:
+                # Unfunded, as is every later batch; a resumed job sends them after a top-up
+                continue
+            sent += batch_sent
+            failed += batch_failed
+            if checkpoint is not None:
+                checkpoint.finish(seq, batch_sent, batch_failed)
+        return error
+
+    max_in_flight = max(1, len(balancer.senders)) * DISPATCH_GATEWAY_CONCURRENCY
+    in_flight = set()
+    try:
+        seq = 0
+        async for batch in batches:
+            if billing is not None and billing.exhausted:
+                break
+            in_flight.add(asyncio.create_task(send(seq, batch)))
+            seq += 1
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                error = collect(done)
+                if error is not None:
+                    raise error
+        if in_flight:
+            done, in_flight = await asyncio.wait(in_flight)
+            error = collect(done)
+            if error is not None:
+                raise error
+    except Exception:
+        if in_flight:
+            done, in_flight = await asyncio.wait(in_flight)
+            collect(done)
+        raise
+    finally:
+        # Only reached with tasks left when cancelled, e.g. after the job's lease was lost
+        for task in in_flight:
+            task.cancel()
+    return sent, failed
+
+async def count_gateway_peers(worker_id: str) -> Counter:
+    # Other workers that sent through, or are waiting on, each gateway in their latest report
+    since = datetime.utcnow() - timedelta(seconds=DISPATCH_STATS_INTERVAL * 3)
+    rows = Collections.gateway_stat.find(
+        {
+            "updated_dt": {"$gte": since},
+            "worker_id": {"$ne": worker_id},
+            "$or": [{"tps": {"$gt": 0}}, {"outstanding": {"$gt": 0}}],
+        },
+        {"_id": 0, "gateway_id": 1},
+    )
+    return Counter([row["gateway_id"] async for row in rows])
+
+async def publish_gateway_stats(balancer: GatewayBalancer, worker_id: str):
+    """Publishes this worker's gateway stats and rescales its tps shares from the other workers'.
+    Shares follow workers starting and stopping within a few stats intervals."""
+    while True:
+        await asyncio.sleep(DISPATCH_STATS_INTERVAL)
+        now = datetime.utcnow()
+        requests = [
+            UpdateOne(
+                {"worker_id": worker_id, "gateway_id": stat["gateway_id"]},
+                {"$set": {**stat, "worker_id": worker_id, "updated_dt": now}},
+                upsert=True,
+            )
+            for stat in balancer.snapshot()
+        ]
+        try:
+            if requests:
+                await Collections.gateway_stat.bulk_write(requests, ordered=False)
+            balancer.share(await count_gateway_peers(worker_id))
+        except PyMongoError:
+            logger.exception("Publishing gateway stats failed for worker %s", worker_id)
+
+async def claim_due_scheduler(worker_id: str):
+    # Atomic claim: only one worker can flip a due job to running; stale leases are reclaimed.
+    # attempt numbers the claims, so a lease is the (_id, worker_id, attempt) triple.
+    now = datetime.utcnow()
+    return await Collections.scheduler.find_one_and_update(
+        {
+            "schedule_dt": {"$lte": now},
+            "$or": [
+                {"status": "pending"},
+                {"status": "running", "claimed_dt": {"$lt": now - timedelta(seconds=DISPATCH_LEASE_SECONDS)}},
+            ],
+        },
+        {"$set": {"status": "running", "worker_id": worker_id, "claimed_dt": now}, "$inc": {"attempt": 1}},
+        sort=[("schedule_dt", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def hold_lease(lease: dict, checkpoint: DispatchCheckpoint, dispatch: asyncio.Task):
+    """Renews the job's lease and saves its resume point every heartbeat. Cancels the dispatch
+    once the lease is held by another claim or cannot be renewed before it would expire."""
+    renewed = time.monotonic()
+    while True:
+        await asyncio.sleep(DISPATCH_HEARTBEAT_SECONDS)
+        try:
+            result = await Collections.scheduler.update_one(
+                {**lease, "status": "running"},
+                {"$set": {"claimed_dt": datetime.utcnow(), "resume": checkpoint.state()}},
+            )
+        except PyMongoError:
+            logger.exception("Lease renewal failed for scheduler job %s", lease["_id"])
+            if time.monotonic() - renewed < DISPATCH_LEASE_SECONDS - 2 * DISPATCH_HEARTBEAT_SECONDS:
+                continue
+        else:
+            if result.matched_count:
+                renewed = time.monotonic()
+                continue
+        logger.warning("Lost lease on scheduler job %s, stopping its dispatch", lease["_id"])
+        dispatch.cancel()
+        return
+
+async def run_scheduler_job(job: dict, balancer: GatewayBalancer, worker_id: str):
+    """Sends one claimed job, resuming from its saved checkpoint. A job that raises is marked
+    failed with its resume point kept, so setting it back to pending continues where it stopped.
+    A job that runs out of credit ends unfunded, resuming at its first unfunded batch after a
+    top-up. A campaign without an account to bill is never sent."""
+    campaign = await Collections.campaign.find_one({"id": job.get("campaign_id")})
+    lease = {"_id": job["_id"], "worker_id": worker_id, "attempt": job.get("attempt")}
+    checkpoint = DispatchCheckpoint(job.get("resume"))
+    counts = {}
+    error = billing = None
+    if campaign and not campaign.get("user_id"):
+        error = ValueError(f"Campaign {campaign['id']} has no user_id to bill")
+        logger.error("Scheduler job %s not sent: %s", job["_id"], error)
+    elif campaign and balancer.senders:
+        # Batch numbers restart with every claim, so the claim attempt keeps ledger refs unique
+        billing = CreditReservation(campaign["user_id"], campaign["id"], f"{job['_id']}:{job.get('attempt', 0)}")
+        dispatch = asyncio.create_task(
+            dispatch_batches(
+                balancer,
+                campaign["id"],
+                iter_campaign_batches(campaign, counts=counts, checkpoint=checkpoint),
+                campaign_template(campaign),
+                billing,
+                checkpoint,
+            )
+        )
+        heartbeat = asyncio.create_task(hold_lease(lease, checkpoint, dispatch))
+        try:
+            await asyncio.wait([dispatch])
+        finally:
+            dispatch.cancel()
+            heartbeat.cancel()
+            await billing.close()
+            counts["unfunded"] = billing.unfunded
+        if dispatch.cancelled():
+            # Another worker holds the job now and resumes it from the last saved checkpoint
+            return "lost"
+        error = dispatch.exception()
+        if error is not None:
+            logger.error("Scheduler job %s failed", job["_id"], exc_info=error)
+    sent, failed = checkpoint.sent, checkpoint.failed
+    if error is None and billing is not None and billing.exhausted:
+        status = "unfunded"
+    elif error is None and campaign and balancer.senders and (sent or not failed):
+        status = "completed"
+    else:
+        status = "failed"
+    await Collections.scheduler.update_one(
+        lease,
+        {
+            "$set": {
+                "status": status,
+                "sent_count": sent,
+                "failed_count": failed,
+                **{f"{key}_count": value for key, value in counts.items()},
+                "resume": checkpoint.state(),
+                "error": None if error is None else repr(error),
+                "completed_dt": datetime.utcnow(),
+            }
+        },
+    )
+    return status
+
+async def run_dispatch_worker(worker_id: Optional[str] = None, once: bool = False):
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=DISPATCH_GATEWAY_CONCURRENCY * 8)
+    async with httpx.AsyncClient(limits=limits, timeout=DISPATCH_HTTP_TIMEOUT) as http:
+        balancer = GatewayBalancer(http)
+        stats_task = asyncio.create_task(publish_gateway_stats(balancer, worker_id))
+        suppression_list.start()
+        try:
+            while True:
+                job = await claim_due_scheduler(worker_id)
+                if job is None:
+                    if once:
+                        return
+                    await asyncio.sleep(DISPATCH_POLL_INTERVAL)
+                    continue
+                balancer.refresh(await Collections.gateway.find({"status": "active"}).to_list(None))
+                balancer.share(await count_gateway_peers(worker_id))
+                await run_scheduler_job(job, balancer, worker_id)
+        finally:
+            stats_task.cancel()
+            if suppression_list.task is not None:
+                suppression_list.task.cancel()
+
+startup_timings["imported_at"] = time.time()
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="SMS platform API and dispatch worker")
+    parser.add_argument(
+        "command", nargs="?", default="serve", choices=["serve", "dispatch", "ensure-indexes", "reconcile"]
+    )
+    args = parser.parse_args()
+    if args.command == "dispatch":
+        asyncio.run(run_dispatch_worker())
+    elif args.command == "ensure-indexes":
+        created = asyncio.run(ensure_indexes())
+        for name, index_names in created.items():
+            print(f"{name}: created {', '.join(index_names)}")
+        print(f"{sum(map(len, created.values()))} indexes created, {sum(map(len, INDEXES.values()))} in registry")
+    elif args.command == "reconcile":
+        print(json.dumps(asyncio.run(reconcile_credits())))
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file